@@ -1,13 +1,38 @@
+import copy
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.decomposition import FastICA
-from sklearn.decomposition import FactorAnalysis
+
+import profiling
 
 
 """Do PCA, ICA, or factor analysis and return components or coefficients."""
+# scikit-learn is imported by the functions that fit, so loading this module stays cheap
+
+FIT_CACHE_SIZE = 8  # Maximum number of fitted models kept in memory
+_fit_cache = OrderedDict()
+PREP_CACHE_SIZE = 4  # Maximum number of preprocessed sample matrices kept in memory
+_prep_cache = OrderedDict()
+HASH_BLOCK = 1 << 24  # Bytes copied at a time when hashing arrays that are not C-contiguous
+
+# How preprocess treats NaN (and infinite) values
+NAN_POLICIES = ('zero', 'mask', 'interpolate')
+# Automatic signal mask: pixels whose peak reaches this fraction of the largest pixel peak
+MASK_THRESHOLD = 0.05
+
+# Solver presets: (PCA svd_solver, FactorAnalysis svd_method, whiten ICA with the PCA fit)
+# FactorAnalysis only offers LAPACK or randomized SVD, so both truncated presets use the latter
+SOLVERS = {'auto': ('auto', 'randomized', False),
+           'exact': ('full', 'lapack', False),
+           'randomized': ('randomized', 'randomized', True),
+           'arpack': ('arpack', 'randomized', True),
+           'fast': ('randomized', 'randomized', True)}
 
 
-def do_analysis(data, normalize=False, n_comp=10, analysis_type='pca'):
+def do_analysis(data, normalize=False, n_comp=10, analysis_type='pca', dtype=None,
+                solver='auto', random_state=None, init=None, nan_policy='zero',
+                mask=None, digest=None):
     """
     Do component analysis on the input data and return a fit object.
     :param data: numpy array, set of images to be analyzed
@@ -18,29 +43,655 @@ def do_analysis(data, normalize=False, n_comp=10, analysis_type='pca'):
                           'pca' for Principal Component Analysis (default)
                           'ica' for Independent Component Analysis
                           'fa' for Factor Analysis
+    :param dtype: optional numpy dtype for the sample matrix, e.g. np.float32 to halve memory
+    :param solver: string for the SVD solver, see SOLVERS
+                   'auto' for the scikit-learn defaults (default)
+                   'exact' for a full LAPACK SVD
+                   'randomized' or 'arpack' for a truncated SVD of only n_comp components,
+                   ICA is then whitened with the cached PCA fit of the same data
+                   'fast' preset, randomized SVD shared between PCA and ICA
+    :param random_state: int seed for FastICA and the randomized solvers, for repeatable fits
+    :param init: optional fit object of the same analysis type from a related dataset
+                 (same image size) used as a warm start; ICA starts from its unmixing
+                 matrix, FA from its noise variances, and the components are reordered
+                 and sign-flipped to match it (PCA only sign-flipped)
+    :param nan_policy: how missing (NaN or infinite) values are handled, see preprocess
+                       'zero' to replace them with 0 (default)
+                       'mask' to zero every pixel that is missing in any image
+                       'interpolate' to fill them from the neighbouring images
+    :param mask: optional boolean numpy array (X x Y) of the pixels to fit, e.g. from
+                 signal_mask, or 'auto' for signal_mask(data); the components are zero
+                 outside the mask
+    :param digest: optional data_hash(data), when the caller has already computed it
     :return: PCA, ICA, or factor analysis object
     """
-    data = np.nan_to_num(data)
+    if digest is None:
+        digest = data_hash(data)
+    return _analyze(data, digest, normalize, n_comp, analysis_type, dtype, solver,
+                    random_state, init, nan_policy, mask)
+
+
+def _analyze(data, digest, normalize, n_comp, analysis_type, dtype, solver, random_state,
+             init, nan_policy, mask=None):
+    """do_analysis for data whose data_hash is already known."""
+    if solver not in SOLVERS:
+        raise ValueError('Unknown solver: ' + str(solver))
+    if analysis_type not in ('pca', 'ica', 'fa'):
+        raise ValueError('Unknown analysis type: ' + str(analysis_type))
+    mask = _resolve_mask(data, mask)
+    with profiling.stage('do_analysis', analysis_type=analysis_type, n_comp=n_comp,
+                         solver=solver) as s:
+        key = _cache_key(digest, normalize, n_comp, analysis_type, dtype, solver,
+                         random_state, init, nan_policy, mask)
+        if key in _fit_cache:
+            _fit_cache.move_to_end(key)
+            s.add(cached=True)
+            return _fit_cache[key]
+
+        data_r = _prepared(data, digest, normalize, dtype, nan_policy, mask)
+        n_pixels = data.shape[0] * data.shape[1]
+        cols = slice(None) if mask is None else np.flatnonzero(mask)
+
+        if init is not None and init.components_.shape[1] != n_pixels:
+            raise ValueError('init was fitted on images of a different size')
+
+        from sklearn.decomposition import PCA, FastICA, FactorAnalysis
+        pca_solver, fa_solver, pca_whiten = SOLVERS[solver]
+        with profiling.stage('fit', shape=data_r.shape, nbytes=data_r.nbytes) as f:
+            if analysis_type == 'pca':
+                fit_object = PCA(n_components=n_comp, svd_solver=pca_solver,
+                                 random_state=random_state)
+                fit_object.fit(data_r)
+            elif analysis_type == 'ica' and (pca_whiten or init is not None):
+                # Whiten with the (cached) PCA of the same data, so init can be mapped into it
+                pca = _analyze(data, digest, normalize, n_comp, 'pca', dtype, solver,
+                               random_state, None, nan_policy, mask)
+                w_init = None
+                if init is not None:
+                    w_init = (np.dot(init.components_, pca.components_.T)
+                              * np.sqrt(pca.explained_variance_))
+                proj = np.dot(data_r - pca.mean_[cols], pca.components_[:, cols].T)
+                fit_object, _ = _ica_from_pca(pca, proj, random_state, w_init)
+            elif analysis_type == 'ica':
+                fit_object = FastICA(n_components=n_comp, whiten='unit-variance',
+                                     random_state=random_state)
+                fit_object.fit(data_r)
+            elif analysis_type == 'fa':
+                noise_init = None if init is None else init.noise_variance_[cols]
+                # scikit-learn seeds FA with 0 by default, keep its fits repeatable
+                fit_object = FactorAnalysis(n_components=n_comp, svd_method=fa_solver,
+                                            random_state=0 if random_state is None
+                                            else random_state,
+                                            noise_variance_init=noise_init)
+                fit_object.fit(data_r)
+            f.add(n_iter=getattr(fit_object, 'n_iter_', None))
+        if fit_object.components_.shape[1] != n_pixels:
+            _unmask_fit(fit_object, cols, n_pixels)
+
+        if init is not None:
+            _align_components(fit_object, init, analysis_type)
+
+        _cache_put(key, fit_object)
+        s.add(cached=False)
+    return fit_object
+
+
+def sweep_components(data, normalize=False, n_comps=range(1, 11), analysis_type='pca',
+                     dtype=None, solver='auto', nan_policy='zero'):
+    """
+    Do component analysis for a range of model orders, to help choose n_comp.
+    PCA and ICA use a single PCA fit of the largest order: every lower order is a truncation
+    of it, and ICA spans the same subspace as its PCA whitening, so the metrics are shared.
+    Factor analysis is refitted for each order, warm-started from the noise variances of
+    the previous order; these fits depend on the sweep, so they are not added to the fit cache.
+    :param data: numpy array, set of images to be analyzed
+                 set of Z images, each X x Y
+    :param normalize: boolean, True to normalize data before doing analysis
+    :param n_comps: list of ints, numbers of components to evaluate
+    :param analysis_type: 'pca' (default), 'ica' or 'fa', see do_analysis
+    :param dtype: optional numpy dtype for the sample matrix, e.g. np.float32 to halve memory
+    :param solver: string for the SVD solver, see SOLVERS
+    :param nan_policy: how missing values are handled, see preprocess
+    :return: dict of numpy arrays, one entry per order
+             'n_comp': the orders, sorted
+             'explained_variance': fraction of the total variance explained
+             'log_likelihood': average log-likelihood per image, probabilistic PCA model
+                               for 'pca' and 'ica', factor analysis model for 'fa'
+             'reconstruction_error': relative Frobenius norm of data minus reconstruction
+    """
+    n_comps = np.array(sorted(n_comps))
+    digest = data_hash(data)
+    data_r = _prepared(data, digest, normalize, dtype, nan_policy)
+    n_images, n_features = data_r.shape
+    centered = data_r - data_r.mean(axis=0)
+    total_ss = np.einsum('ij,ij->', centered, centered)
+    del centered
+
+    if analysis_type in ('pca', 'ica'):
+        pca = _analyze(data, digest, normalize, n_comps[-1], 'pca', dtype, solver, None, None,
+                       nan_policy)
+        # Eigenvalues of the sample covariance (maximum likelihood normalization)
+        eigvals = pca.singular_values_**2 / n_images
+        kept = np.cumsum(eigvals)[n_comps - 1]
+        explained = kept * n_images / total_ss
+        error = np.sqrt(np.maximum(1 - explained, 0))
+        noise = np.maximum(total_ss / n_images - kept, np.finfo(float).tiny) / (n_features - n_comps)
+        log_eig = np.cumsum(np.log(eigvals))[n_comps - 1]
+        loglike = -0.5 * (n_features * np.log(2 * np.pi) + log_eig
+                          + (n_features - n_comps) * np.log(noise) + n_features)
+    elif analysis_type == 'fa':
+        from sklearn.decomposition import FactorAnalysis
+        fa_solver = SOLVERS[solver][1]
+        explained = np.zeros(len(n_comps))
+        error = np.zeros(len(n_comps))
+        loglike = np.zeros(len(n_comps))
+        noise_init = None
+        for i, n_comp in enumerate(n_comps):
+            fa = FactorAnalysis(n_components=n_comp, svd_method=fa_solver,
+                                noise_variance_init=noise_init)
+            fa.fit(data_r)
+            noise_init = fa.noise_variance_
+            resid = data_r - np.dot(fa.transform(data_r), fa.components_) - fa.mean_
+            explained[i] = np.einsum('ij,ij->', fa.components_, fa.components_) * n_images / total_ss
+            error[i] = np.sqrt(np.einsum('ij,ij->', resid, resid) / total_ss)
+            loglike[i] = fa.loglike_[-1] / n_images
+    else:
+        raise ValueError('Unknown analysis type: ' + str(analysis_type))
+
+    return {'n_comp': n_comps, 'explained_variance': explained,
+            'log_likelihood': loglike, 'reconstruction_error': error}
+
+
+def preprocess(data, normalize=False, dtype=None, nan_policy='zero', copy=True, mask=None):
+    """
+    Validate a set of images and turn it into the sample matrix used by the fits.
+    This is the one preprocessing stage of the module: missing values are handled, each image
+    is optionally scaled by its peak absolute value, and the images become rows.
+    :param data: numpy array (or numpy.memmap), set of Z images, each X x Y
+    :param normalize: boolean, True to scale each image by its peak absolute value
+    :param dtype: optional numpy dtype for the result, e.g. np.float32
+    :param nan_policy: how missing (NaN or infinite) values are handled
+                       'zero' to replace them with 0 (default)
+                       'mask' to zero every pixel that is missing in any image, so all images
+                       keep the same set of valid pixels
+                       'interpolate' to fill them linearly from the nearest valid images of
+                       the same pixel (pixels missing from every image are zeroed)
+    :param copy: boolean, True (default) to never modify data; False to allow working in
+                 place when data is C-ordered with the result dtype, overwriting its values
+    :param mask: optional boolean numpy array (X x Y), keep only these pixels (columns);
+                 they are gathered before anything else, and images are normalized by their
+                 peak within the mask
+    :return: numpy array with dimensions (Z, X*Y), or (Z, number of pixels in mask); without
+             missing values, normalization or mask this is a view of data when its memory
+             order allows, see reshape_image
+    """
+    if np.ndim(data) != 3:
+        raise ValueError('data must be a set of images with dimensions (X, Y, Z)')
+    if nan_policy not in NAN_POLICIES:
+        raise ValueError('Unknown NaN policy: ' + str(nan_policy))
+    with profiling.stage('preprocess', nbytes=data.nbytes, normalize=normalize,
+                         nan_policy=nan_policy) as s:
+        if mask is None:
+            data_r = reshape_image(data, dtype)
+        else:
+            # Boolean indexing gathers the pixels in reshape_image order
+            data_r = np.ascontiguousarray(np.asarray(data)[np.asarray(mask, dtype=bool)].T,
+                                          dtype=dtype)
+        if not np.issubdtype(data_r.dtype, np.inexact):
+            data_r = data_r.astype(float)
+        missing = ~np.isfinite(data_r)
+        n_missing = np.count_nonzero(missing)
+        if copy and (n_missing or normalize) and np.shares_memory(data_r, data):
+            data_r = data_r.copy()
+        if n_missing:
+            _fill_missing(data_r, missing, nan_policy)
+        if normalize:
+            data_r /= _peaks(data_r)
+        s.add(n_missing=n_missing)
+    return data_r
+
+
+def _fill_missing(data_r, missing, nan_policy):
+    """
+    Replace the missing values of a sample matrix in place, see preprocess.
+    :param data_r: numpy array with dimensions (Z, X*Y), modified in place
+    :param missing: boolean numpy array of the same shape, True where values are missing
+    :param nan_policy: 'zero', 'mask' or 'interpolate'
+    """
+    if nan_policy == 'zero':
+        data_r[missing] = 0
+        return
+    cols = np.flatnonzero(missing.any(axis=0))
+    if nan_policy == 'mask':
+        data_r[:, cols] = 0
+        return
+
+    # Index of the previous and next valid image of every entry, for all columns at once
+    valid = ~missing[:, cols]
+    sub = np.where(valid, data_r[:, cols], 0)
+    n_images = sub.shape[0]
+    idx = np.arange(n_images)[:, None]
+    prev = np.maximum.accumulate(np.where(valid, idx, -1), axis=0)
+    nxt = np.minimum.accumulate(np.where(valid, idx, n_images)[::-1], axis=0)[::-1]
+    has_prev = prev >= 0
+    has_next = nxt < n_images
+    prev = np.clip(prev, 0, n_images - 1)
+    nxt = np.clip(nxt, 0, n_images - 1)
+    y_prev = np.take_along_axis(sub, prev, axis=0)
+    y_next = np.take_along_axis(sub, nxt, axis=0)
+    weight = (idx - prev) / np.maximum(nxt - prev, 1)
+    filled = np.where(has_prev & has_next, y_prev + weight * (y_next - y_prev),
+                      np.where(has_prev, y_prev, np.where(has_next, y_next, 0)))
+    data_r[:, cols] = np.where(valid, sub, filled)
+
+
+def _peaks(data_r):
+    """Peak absolute value of each row of a sample matrix, as a column (1 for empty rows)."""
+    peak = np.maximum(data_r.max(axis=1), -data_r.min(axis=1))
+    peak[peak == 0] = 1
+    return peak[:, None]
+
+
+def _prepared(data, digest, normalize, dtype, nan_policy, mask=None):
+    """
+    Return the preprocessed sample matrix of data, reusing a previous result when possible.
+    Results that are not views of data are kept (read-only) in a small cache, and a normalized
+    matrix is derived from the cached unnormalized one, so fits and projections of the same
+    data share one preprocessing pass.
+    :param data: numpy array, set of Z images, each X x Y
+    :param digest: data_hash of data
+    :param mask: optional boolean numpy array (X x Y) of the pixels to keep
+    :return: numpy array with dimensions (Z, X*Y) or (Z, pixels in mask), must not be modified
+    """
+    key = (digest, normalize, np.dtype(dtype).str if dtype else None, nan_policy,
+           None if mask is None else data_hash(mask))
+    if key in _prep_cache:
+        _prep_cache.move_to_end(key)
+        return _prep_cache[key]
     if normalize:
-        for idx in range(data.shape[2]):
-                img = data[:, :, idx]
-                peak = np.abs(img).max()
-                img = img / peak
-                data[:, :, idx] = img
+        data_r = _prepared(data, digest, False, dtype, nan_policy, mask)
+        with profiling.stage('normalize', nbytes=data_r.nbytes):
+            data_r = data_r / _peaks(data_r)
+    else:
+        data_r = preprocess(data, False, dtype, nan_policy, mask=mask)
+        if np.shares_memory(data_r, data):
+            return data_r
+    data_r.setflags(write=False)
+    _prep_cache[key] = data_r
+    while len(_prep_cache) > PREP_CACHE_SIZE:
+        _prep_cache.popitem(last=False)
+    return data_r
+
+
+def signal_mask(data, w1=None, w3=None, window=None, threshold=None):
+    """
+    Select the pixels of a set of images to analyze, by frequency window and/or signal level.
+    :param data: numpy array, set of Z images, each X x Y
+    :param w1: w1 axis (cm-1), X or X x 1 numpy array, needed for window
+    :param w3: w3 axis (cm-1), Y or Y x 1 numpy array, needed for window
+    :param window: optional ((w1 min, w1 max), (w3 min, w3 max)) in cm-1, either pair may be
+                   None to keep the whole axis
+    :param threshold: optional fraction of the largest pixel peak; keep the pixels whose peak
+                      absolute value over all images reaches it (default: MASK_THRESHOLD
+                      when no window is given, otherwise not applied)
+    :return: boolean numpy array with dimensions (X, Y)
+    """
+    mask = np.ones(data.shape[:2], dtype=bool)
+    if window is not None:
+        for axis, limits, name in ((0, window[0], 'w1'), (1, window[1], 'w3')):
+            if limits is None:
+                continue
+            values = w1 if axis == 0 else w3
+            if values is None:
+                raise ValueError(name + ' is needed for a frequency window')
+            values = np.ravel(values)
+            inside = (values >= min(limits)) & (values <= max(limits))
+            mask &= inside[:, None] if axis == 0 else inside[None, :]
+    elif threshold is None:
+        threshold = MASK_THRESHOLD
+    if threshold is not None:
+        peak = np.zeros(data.shape[:2])
+        for start in range(0, data.shape[2], 64):
+            images = np.abs(np.nan_to_num(np.asarray(data[:, :, start:start + 64])))
+            np.maximum(peak, images.max(axis=2), out=peak)
+        mask &= peak >= threshold * peak.max()
+    if not mask.any():
+        raise ValueError('The mask selects no pixels')
+    return mask
+
+
+def _resolve_mask(data, mask):
+    """Return mask as a boolean (X x Y) array, or None to use all pixels."""
+    if mask is None:
+        return None
+    if isinstance(mask, str):
+        if mask != 'auto':
+            raise ValueError('Unknown mask: ' + mask)
+        return signal_mask(data)
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape != data.shape[:2]:
+        raise ValueError('mask must have the size of one image')
+    return mask
+
+
+def _unmask_fit(fit_object, cols, n_pixels):
+    """
+    Scatter a fit object fitted on some pixels back to full-size images, in place.
+    Components, mean and mixing matrix are zero outside the fitted pixels, so transform and
+    reconstruct accept whole images; FA noise variances outside are infinite.
+    :param fit_object: PCA, ICA, or factor analysis object
+    :param cols: indices of the fitted pixels in the flattened image
+    :param n_pixels: int, number of pixels in an image
+    """
+    def scatter(values, axis, fill=0.0):
+        shape = list(values.shape)
+        shape[axis] = n_pixels
+        full = np.full(shape, fill, dtype=values.dtype)
+        full[(slice(None),) * axis + (cols,)] = values
+        return full
+
+    fit_object.components_ = scatter(fit_object.components_, 1)
+    fit_object.mean_ = scatter(fit_object.mean_, 0)
+    if hasattr(fit_object, 'mixing_'):
+        fit_object.mixing_ = scatter(fit_object.mixing_, 0)
+    if hasattr(fit_object, 'whitening_'):
+        fit_object.whitening_ = scatter(fit_object.whitening_, 1)
+    if np.ndim(getattr(fit_object, 'noise_variance_', None)) == 1:
+        fit_object.noise_variance_ = scatter(fit_object.noise_variance_, 0, np.inf)
+    fit_object.n_features_in_ = n_pixels
+
+
+def _transform(fit_object, data_r, mask=None):
+    """
+    Project a sample matrix onto the components of a fit object.
+    With a mask, data_r holds only the masked pixels and is projected onto the components
+    restricted to them, which gives the same result as the full images because the fit is
+    zero (FA: infinite noise variance) outside the mask.
+    :param fit_object: PCA, ICA, or factor analysis object
+    :param data_r: numpy array with dimensions (Z, X*Y), or (Z, pixels in mask) with a mask
+    :param mask: optional boolean numpy array (X x Y) of the pixels in data_r
+    :return: numpy array with dimensions (Z, n_comp)
+    """
+    if mask is None:
+        return fit_object.transform(data_r)
+    cols = np.flatnonzero(mask)
+    fit_object = copy.copy(fit_object)
+    fit_object.components_ = fit_object.components_[:, cols]
+    fit_object.mean_ = fit_object.mean_[cols]
+    if hasattr(fit_object, 'whitening_'):
+        fit_object.whitening_ = fit_object.whitening_[:, cols]
+    if np.ndim(getattr(fit_object, 'noise_variance_', None)) == 1:
+        fit_object.noise_variance_ = fit_object.noise_variance_[cols]
+    fit_object.n_features_in_ = len(cols)
+    return fit_object.transform(data_r)
 
-    data_r = reshape_image(data)
 
+def _cache_key(digest, normalize, n_comp, analysis_type, dtype, solver, random_state=None,
+               init=None, nan_policy='zero', mask=None):
+    """Return the fit cache key for a set of do_analysis arguments, digest is data_hash(data)."""
+    return (digest, normalize, n_comp, analysis_type,
+            np.dtype(dtype).str if dtype else None, solver, random_state,
+            None if init is None else data_hash(init.components_), nan_policy,
+            None if mask is None else data_hash(mask))
+
+
+def _align_components(fit_object, init, analysis_type):
+    """
+    Reorder and sign-flip the components of a fit object in place to best match a reference.
+    PCA components keep their variance order and are only sign-flipped.
+    :param fit_object: fitted PCA, ICA, or factor analysis object
+    :param init: fit object of the same analysis type to match
+    """
+    comp = fit_object.components_
+    a = comp / np.linalg.norm(comp, axis=1)[:, None]
+    b = init.components_ / np.linalg.norm(init.components_, axis=1)[:, None]
+    overlap = np.dot(a, b.T)
     if analysis_type == 'pca':
-        fit_object = PCA(n_components=n_comp)
-    elif analysis_type == 'ica':
-        fit_object = FastICA(n_components=n_comp, whiten=True)
-    elif analysis_type == 'fa':
-        fit_object = FactorAnalysis(n_components=n_comp)
-    fit_object.fit(data_r)
-    return fit_object
+        order = np.arange(comp.shape[0])
+    else:
+        from scipy.optimize import linear_sum_assignment
+        rows, cols = linear_sum_assignment(-np.abs(overlap))
+        matched = rows[np.argsort(cols)]
+        order = np.concatenate([matched, np.setdiff1d(np.arange(comp.shape[0]), matched)])
+    n_match = min(comp.shape[0], init.components_.shape[0])
+    signs = np.ones(comp.shape[0])
+    signs[:n_match] = np.sign(overlap[order[:n_match], np.arange(n_match)])
+    signs[signs == 0] = 1
 
+    fit_object.components_ = comp[order] * signs[:, None]
+    if analysis_type == 'ica':
+        fit_object.mixing_ = fit_object.mixing_[:, order] * signs
 
-def get_components(data, normalize=False, n_comp=10, analysis_type='pca'):
+
+def _cache_put(key, fit_object):
+    """
+    Add a fit object to the fit cache, evicting the least recently used ones.
+    Its fitted arrays (components_, mixing_, mean_, ...) are made read-only, since the same
+    object, and views of its arrays such as get_components images, are handed out again.
+    """
+    for value in vars(fit_object).values():
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+    _fit_cache[key] = fit_object
+    while len(_fit_cache) > FIT_CACHE_SIZE:
+        _fit_cache.popitem(last=False)
+
+
+def _ica_from_pca(pca, proj, random_state=None, w_init=None):
+    """
+    Run FastICA on data already whitened by a fitted PCA object.
+    The returned FastICA object maps the original data like one fitted with whitening.
+    :param pca: fitted PCA or IncrementalPCA object
+    :param proj: numpy array with dimensions (Z, n_comp), PCA projections of the data
+    :param random_state: int seed for FastICA
+    :param w_init: optional (n_comp, n_comp) initial unmixing matrix in the whitened space
+    :return: FastICA object and numpy array with dimensions (Z, n_comp), the sources
+    """
+    from sklearn.decomposition import FastICA
+    scale = np.sqrt(pca.explained_variance_)
+    whitening = pca.components_ / scale[:, None]
+    ica = FastICA(whiten=False, random_state=random_state, w_init=w_init)
+    sources = ica.fit_transform(proj / scale)
+    ica.whitening_ = whitening
+    ica.components_ = np.dot(ica.components_, whitening)
+    ica.mixing_ = np.linalg.pinv(ica.components_)
+    ica.mean_ = pca.mean_
+    ica.whiten = 'unit-variance'
+    ica.n_components = pca.n_components
+    ica.n_features_in_ = pca.components_.shape[1]
+    return ica, sources
+
+
+def stream_analysis(data, normalize=False, n_comp=10, analysis_type='pca', chunk_size=64,
+                    dtype=None):
+    """
+    Do component analysis on a stack too large for memory, a chunk of tau2 slices at a time.
+    The fit uses incremental PCA over the chunks, then a second pass projects each chunk.
+    Peak memory scales with chunk_size * X * Y rather than with the whole stack.
+    :param data: array-like with a shape attribute and slicing, e.g. numpy.memmap from
+                 util.loadData, set of Z images, each X x Y
+    :param normalize: boolean, True to normalize data before doing analysis
+    :param n_comp: int, number of components to generate
+    :param analysis_type: string for the type of analysis to perform
+                          'pca' for Principal Component Analysis (default)
+                          'ica' for Independent Component Analysis, whitened by the streamed PCA
+    :param chunk_size: int, number of images per chunk (at least n_comp)
+    :param dtype: optional numpy dtype for each chunk, e.g. np.float32 to halve memory
+    :return: fit object and numpy array with dimensions (Z, n_comp)
+             corresponding to the contribution of each component to each original image
+    """
+    if analysis_type not in ('pca', 'ica'):
+        raise ValueError('Streaming analysis supports pca and ica, not ' + str(analysis_type))
+    n_images = data.shape[2]
+    chunk_size = max(chunk_size, n_comp)
+    bounds = [(i, min(i + chunk_size, n_images)) for i in range(0, n_images, chunk_size)]
+    # Fold a short last chunk into the previous one, partial_fit needs n_comp samples
+    if len(bounds) > 1 and bounds[-1][1] - bounds[-1][0] < n_comp:
+        bounds[-2:] = [(bounds[-2][0], n_images)]
+
+    from sklearn.decomposition import IncrementalPCA
+    pca = IncrementalPCA(n_components=n_comp)
+    for start, stop in bounds:
+        pca.partial_fit(preprocess(data[:, :, start:stop], normalize, dtype))
+
+    # Project the images as measured, like get_projections, so they keep their decay over
+    # tau2; ICA is fitted on the projections of the images the PCA was fitted on
+    proj = []
+    fit_proj = []
+    for start, stop in bounds:
+        chunk = preprocess(data[:, :, start:stop], False, dtype)
+        proj.append(pca.transform(chunk))
+        if normalize and analysis_type == 'ica':
+            fit_proj.append(pca.transform(chunk / _peaks(chunk)))
+    proj = np.concatenate(proj)
+
+    if analysis_type == 'ica':
+        ica, _ = _ica_from_pca(pca, np.concatenate(fit_proj) if normalize else proj)
+        # Sources of the measured images, ica.transform without a second pass over the data
+        return ica, np.dot(proj, np.dot(ica.components_, pca.components_.T).T)
+    return pca, proj
+
+
+def joint_analysis(datasets, normalize=False, n_comp=10, analysis_type='pca', dtype=None,
+                   solver='auto', random_state=None, nan_policy='zero', w1=None, w3=None):
+    """
+    Fit one component basis shared by several datasets (e.g. solvents) with different axes.
+    Every dataset is regridded onto common w1 and w3 axes with precomputed linear
+    interpolation matrices, the images of all datasets are stacked into one sample matrix
+    and a single fit is done, so components are directly comparable across datasets.
+    :param datasets: dict of name -> (data, w1, w3, tau2), e.g. from util.loadSolvent,
+                     each data a set of Z images, each X x Y
+    :param normalize: boolean, True to normalize each image before doing analysis
+    :param n_comp: int, number of components to generate
+    :param analysis_type: 'pca' (default), 'ica' or 'fa', see do_analysis
+    :param dtype: optional numpy dtype for the sample matrix, e.g. np.float32 to halve memory
+    :param solver: string for the SVD solver, see SOLVERS
+    :param random_state: int seed for FastICA and the randomized solvers, for repeatable fits
+    :param nan_policy: how missing values are handled, see preprocess
+    :param w1: optional common w1 axis (default: see common_axis)
+    :param w3: optional common w3 axis (default: see common_axis)
+    :return: fit object
+             w1, w3: the common axes, X x 1 and Y x 1 numpy arrays
+             dict of name -> numpy array with dimensions (Z, n_comp), projection of each
+             dataset onto the shared components, all slices of one stacked array
+    """
+    names = list(datasets)
+    if w1 is None:
+        w1 = common_axis([datasets[name][1] for name in names])
+    if w3 is None:
+        w3 = common_axis([datasets[name][2] for name in names])
+    n_w1, n_w3 = len(w1), len(w3)
+    bounds = np.cumsum([0] + [datasets[name][0].shape[2] for name in names])
+
+    # Regrid every dataset straight into its rows of the stacked sample matrix
+    stacked = np.empty((bounds[-1], n_w1 * n_w3), dtype or float)
+    weights = {}
+    with profiling.stage('regrid', n_datasets=len(names), nbytes=stacked.nbytes):
+        for name, start, stop in zip(names, bounds[:-1], bounds[1:]):
+            data, w1_s, w3_s = datasets[name][:3]
+            w_x = _cached_weights(weights, w1_s, w1)
+            w_y = _cached_weights(weights, w3_s, w3)
+            images = preprocess(data, False, dtype, nan_policy).reshape(
+                stop - start, data.shape[0], data.shape[1])
+            regridded = stacked[start:stop].reshape(stop - start, n_w1, n_w3)
+            np.matmul(np.matmul(w_x, images), w_y.T, out=regridded)
+
+    # Fit on the stack (normalized if asked), project the stack as measured
+    fit_data = stacked / _peaks(stacked) if normalize else stacked
+    fit_object = do_analysis(unreshape_image(fit_data, n_w1, n_w3), False, n_comp,
+                             analysis_type, dtype, solver, random_state)
+    with profiling.stage('transform', analysis_type=analysis_type, n_comp=n_comp):
+        proj = fit_object.transform(stacked)
+    projections = OrderedDict((name, proj[start:stop])
+                              for name, start, stop in zip(names, bounds[:-1], bounds[1:]))
+    return fit_object, w1, w3, projections
+
+
+def common_axis(axes, n_points=None):
+    """
+    Return an evenly spaced axis covering the range shared by all the given axes.
+    :param axes: list of axes, each N or N x 1 numpy array
+    :param n_points: int, number of points (default: the fewest points any axis has
+                     inside the shared range)
+    :return: numpy array with dimensions (n_points, 1)
+    """
+    axes = [np.ravel(axis) for axis in axes]
+    low = max(axis.min() for axis in axes)
+    high = min(axis.max() for axis in axes)
+    if low >= high:
+        raise ValueError('The axes do not overlap')
+    if n_points is None:
+        n_points = min(np.count_nonzero((axis >= low) & (axis <= high)) for axis in axes)
+    return np.linspace(low, high, max(n_points, 2)).reshape(-1, 1)
+
+
+def interp_weights(src, dst):
+    """
+    Return the matrix of linear interpolation weights from one axis onto another.
+    Values outside the range of src take the value at the nearest end.
+    :param src: axis the data is sampled on, N or N x 1 numpy array, in any order
+    :param dst: axis to interpolate onto, M or M x 1 numpy array
+    :return: numpy array with dimensions (M, N), so that np.dot(weights, values) interpolates
+             values (N or N x K) onto dst
+    """
+    src = np.ravel(src).astype(float)
+    dst = np.ravel(dst).astype(float)
+    order = np.argsort(src, kind='stable')
+    sorted_src = src[order]
+    upper = np.clip(np.searchsorted(sorted_src, dst), 1, max(len(src) - 1, 1))
+    lower = upper - 1
+    if len(src) == 1:
+        upper = lower = np.zeros(len(dst), dtype=int)
+    span = sorted_src[upper] - sorted_src[lower]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(span > 0, (dst - sorted_src[lower]) / span, 0)
+    frac = np.clip(frac, 0, 1)
+    weights = np.zeros((len(dst), len(src)))
+    rows = np.arange(len(dst))
+    np.add.at(weights, (rows, order[lower]), 1 - frac)
+    np.add.at(weights, (rows, order[upper]), frac)
+    return weights
+
+
+def _cached_weights(weights, src, dst):
+    """interp_weights(src, dst), reused from the dict weights for repeated source axes."""
+    key = np.ravel(src).tobytes()
+    if key not in weights:
+        weights[key] = interp_weights(src, dst)
+    return weights[key]
+
+
+def data_hash(data):
+    """
+    Return a content hash of a data array, used to key the fit cache.
+    The values are hashed in C order whatever the memory layout, so equal arrays get equal
+    hashes; arrays that are not C-contiguous (e.g. Fortran-ordered stacks from loadmat) are
+    read in blocks of rows of about HASH_BLOCK bytes rather than copied whole.
+    :param data: numpy array of any shape
+    :return: hex digest string covering the shape, dtype and values
+    """
+    data = np.asanyarray(data)
+    with profiling.stage('hash', nbytes=data.nbytes):
+        h = hashlib.sha1(str((data.shape, data.dtype.str)).encode())
+        if data.flags.c_contiguous or data.ndim < 2:
+            h.update(np.ascontiguousarray(data).view(np.uint8).ravel())
+        else:
+            rows = max(1, HASH_BLOCK // max(data[0].nbytes, 1))
+            for start in range(0, data.shape[0], rows):
+                block = np.ascontiguousarray(data[start:start + rows])
+                h.update(block.view(np.uint8).ravel())
+        return h.hexdigest()
+
+
+def clear_cache():
+    """Discard all fitted models and preprocessed data held in the caches."""
+    _fit_cache.clear()
+    _prep_cache.clear()
+
+
+def get_components(data, normalize=False, n_comp=10, analysis_type='pca', dtype=None,
+                   solver='auto', random_state=None, init=None, nan_policy='zero',
+                   mask=None):
     """
     Do component analysis on the input data and return set of component images.
     :param data: numpy array, set of images to be analyzed
@@ -51,18 +702,36 @@ def get_components(data, normalize=False, n_comp=10, analysis_type='pca'):
                           'pca' for Principal Component Analysis (default)
                           'ica' for Independent Component Analysis
                           'fa' for Factor Analysis
+    :param dtype: optional numpy dtype for the sample matrix, e.g. np.float32 to halve memory
+    :param solver: string for the SVD solver, see SOLVERS
+                   'auto' for the scikit-learn defaults (default)
+                   'exact' for a full LAPACK SVD
+                   'randomized' or 'arpack' for a truncated SVD of only n_comp components,
+                   ICA is then whitened with the cached PCA fit of the same data
+                   'fast' preset, randomized SVD shared between PCA and ICA
+    :param random_state: int seed for FastICA and the randomized solvers, for repeatable fits
+    :param init: optional fit object of the same analysis type from a related dataset
+                 (same image size) used as a warm start; ICA starts from its unmixing
+                 matrix, FA from its noise variances, and the components are reordered
+                 and sign-flipped to match it (PCA only sign-flipped)
+    :param nan_policy: how missing (NaN or infinite) values are handled, see preprocess
+                       'zero' to replace them with 0 (default)
+                       'mask' to zero every pixel that is missing in any image
+                       'interpolate' to fill them from the neighbouring images
+    :param mask: optional boolean numpy array (X x Y) of the pixels to fit, e.g. from
+                 signal_mask, or 'auto' for signal_mask(data); the components are zero
+                 outside the mask
     :return: numpy array with dimensions (X, Y, n_comp)
-             set of n_comp images, each X x Y
+             set of n_comp images, each X x Y, a read-only view of the cached fit
     """
-    data = np.nan_to_num(data)
-    fit_object = do_analysis(data, normalize, n_comp, analysis_type)
-    comp = np.zeros((data.shape[0], data.shape[1], fit_object.components_.shape[0]))
-    for i in range(fit_object.components_.shape[0]):
-        comp[:, :, i] = fit_object.components_[i].reshape(data.shape[0], data.shape[1])
-    return comp
+    fit_object = do_analysis(data, normalize, n_comp, analysis_type, dtype, solver,
+                             random_state, init, nan_policy, mask)
+    return unreshape_image(fit_object.components_, data.shape[0], data.shape[1])
 
 
-def get_projections(data, normalize=False, n_comp=10, analysis_type='pca'):
+def get_projections(data, normalize=False, n_comp=10, analysis_type='pca', dtype=None,
+                    solver='auto', random_state=None, init=None, nan_policy='zero',
+                    mask=None):
     """
     Do PCA on the input data and return projection of original data onto components.
     :param data: numpy array, set of images to be analyzed
@@ -73,22 +742,147 @@ def get_projections(data, normalize=False, n_comp=10, analysis_type='pca'):
                           'pca' for Principal Component Analysis (default)
                           'ica' for Independent Component Analysis
                           'fa' for Factor Analysis
+    :param dtype: optional numpy dtype for the sample matrix, e.g. np.float32 to halve memory
+    :param solver: string for the SVD solver, see SOLVERS
+                   'auto' for the scikit-learn defaults (default)
+                   'exact' for a full LAPACK SVD
+                   'randomized' or 'arpack' for a truncated SVD of only n_comp components,
+                   ICA is then whitened with the cached PCA fit of the same data
+                   'fast' preset, randomized SVD shared between PCA and ICA
+    :param random_state: int seed for FastICA and the randomized solvers, for repeatable fits
+    :param init: optional fit object of the same analysis type from a related dataset
+                 (same image size) used as a warm start; ICA starts from its unmixing
+                 matrix, FA from its noise variances, and the components are reordered
+                 and sign-flipped to match it (PCA only sign-flipped)
+    :param nan_policy: how missing (NaN or infinite) values are handled, see preprocess
+                       'zero' to replace them with 0 (default)
+                       'mask' to zero every pixel that is missing in any image
+                       'interpolate' to fill them from the neighbouring images
+    :param mask: optional boolean numpy array (X x Y) of the pixels to fit, e.g. from
+                 signal_mask, or 'auto' for signal_mask(data); the components are zero
+                 outside the mask
     :return: numpy array with dimensions (Z, n_comp)
              corresponding to the contribution of each component to each original image
     """
-    data = np.nan_to_num(data)
-    fit_object = do_analysis(data, normalize, n_comp, analysis_type)
-    data_r = reshape_image(data)
-    return fit_object.transform(data_r)
+    digest = data_hash(data)
+    mask = _resolve_mask(data, mask)
+    fit_object = _analyze(data, digest, normalize, n_comp, analysis_type, dtype, solver,
+                          random_state, init, nan_policy, mask)
+    # Projections are of the images as measured, so they keep their decay over tau2
+    data_r = _prepared(data, digest, False, dtype, nan_policy, mask)
+    with profiling.stage('transform', analysis_type=analysis_type, n_comp=n_comp):
+        return _transform(fit_object, data_r, mask)
+
+
+def get_reconstruction(data, normalize=False, n_comp=10, analysis_type='pca', dtype=None,
+                       solver='auto', random_state=None, init=None, nan_policy='zero',
+                       mask=None):
+    """
+    Do component analysis on the input data and return the data rebuilt from the components.
+    :param data: numpy array, set of images to be analyzed
+                 set of Z images, each X x Y
+    :param normalize: boolean, True to normalize data before doing analysis
+    :param n_comp: int, number of components to generate
+    :param analysis_type: string for the type of analysis to perform
+                          'pca' for Principal Component Analysis (default)
+                          'ica' for Independent Component Analysis
+                          'fa' for Factor Analysis
+    :param dtype: optional numpy dtype for the sample matrix, e.g. np.float32 to halve memory
+    :param solver: string for the SVD solver, see SOLVERS
+                   'auto' for the scikit-learn defaults (default)
+                   'exact' for a full LAPACK SVD
+                   'randomized' or 'arpack' for a truncated SVD of only n_comp components,
+                   ICA is then whitened with the cached PCA fit of the same data
+                   'fast' preset, randomized SVD shared between PCA and ICA
+    :param random_state: int seed for FastICA and the randomized solvers, for repeatable fits
+    :param init: optional fit object of the same analysis type from a related dataset
+                 (same image size) used as a warm start; ICA starts from its unmixing
+                 matrix, FA from its noise variances, and the components are reordered
+                 and sign-flipped to match it (PCA only sign-flipped)
+    :param nan_policy: how missing (NaN or infinite) values are handled, see preprocess
+                       'zero' to replace them with 0 (default)
+                       'mask' to zero every pixel that is missing in any image
+                       'interpolate' to fill them from the neighbouring images
+    :param mask: optional boolean numpy array (X x Y) of the pixels to fit, e.g. from
+                 signal_mask, or 'auto' for signal_mask(data); the components are zero
+                 outside the mask
+    :return: numpy array with dimensions (X, Y, Z)
+             set of Z reconstructed images, each X x Y
+    """
+    digest = data_hash(data)
+    mask = _resolve_mask(data, mask)
+    fit_object = _analyze(data, digest, normalize, n_comp, analysis_type, dtype, solver,
+                          random_state, init, nan_policy, mask)
+    proj = _transform(fit_object, _prepared(data, digest, False, dtype, nan_policy, mask), mask)
+    return reconstruct(fit_object, proj, data.shape[:2])
+
+
+def reconstruct(fit_object, proj, shape, comp_nums=None, frames=None, mean=True, out=None):
+    """
+    Rebuild (denoise) images from a subset of the components with a single matrix product.
+    :param fit_object: PCA, ICA, or factor analysis object from do_analysis
+    :param proj: projection of data onto components, Z x n_comp numpy array
+    :param shape: (X, Y), the size of each image
+    :param comp_nums: components to use: None for all, an int k for the first k,
+                      or a list of component numbers (1 through n_comp)
+    :param frames: optional list of frame indices into proj (default: all Z frames)
+    :param mean: boolean, True to add back the mean image removed by the fit
+    :param out: optional preallocated C-ordered numpy array or numpy.memmap with
+                dimensions (X, Y, n_frames) and the result dtype, written in place
+    :return: numpy array with dimensions (X, Y, n_frames)
+             set of reconstructed images, each X x Y
+    """
+    # Rows of the basis map projections back to pixels: ICA uses the mixing matrix
+    if hasattr(fit_object, 'mixing_'):
+        basis = fit_object.mixing_.T
+    else:
+        basis = fit_object.components_
+    if comp_nums is None:
+        sel = slice(None)
+    elif np.ndim(comp_nums) == 0:
+        sel = slice(0, comp_nums)
+    else:
+        sel = np.asarray(comp_nums) - 1
+    proj = proj[:, sel] if frames is None else proj[np.asarray(frames)][:, sel]
+    basis = basis[sel]
+
+    n_pixels = shape[0] * shape[1]
+    if out is None:
+        out = np.empty((shape[0], shape[1], proj.shape[0]), np.result_type(basis, proj))
+    elif not out.flags.c_contiguous:
+        raise ValueError('out must be a C-ordered array')
+    flat = out.reshape(n_pixels, proj.shape[0])
+    np.dot(basis.T, proj.T, out=flat)
+    if mean and np.ndim(getattr(fit_object, 'mean_', None)):
+        flat += fit_object.mean_[:, None]
+    return out
 
 
-def reshape_image(data):
+def reshape_image(data, dtype=None):
     """
     Reshape each 2D image in the stack into 1D
     example: 109 x 109 x 13 original matrix (stack of 13 109x109 images)
         becomes 13 x 11881 (since 11881 = 109 x 109)
+    The result is a view of the input when its memory order allows (C-ordered stacks),
+    otherwise a single contiguous copy (e.g. Fortran-ordered arrays from loadmat).
+    :param data: numpy array, set of Z images, each X x Y
+    :param dtype: optional numpy dtype for the result, e.g. np.float32
+    :return: numpy array with dimensions (Z, X*Y)
     """
-    data_r = np.zeros((data.shape[2], data.shape[0] * data.shape[1]))
-    for i in range(data.shape[2]):
-        data_r[i] = data[:,:,i].ravel()
+    data_r = np.moveaxis(data, 2, 0).reshape(data.shape[2], -1)
+    if dtype is not None:
+        data_r = data_r.astype(dtype, copy=False)
     return data_r
+
+
+def unreshape_image(data_r, x, y):
+    """
+    Reshape each 1D row back into a 2D image, the inverse of reshape_image.
+    example: 10 x 11881 components_ matrix becomes 109 x 109 x 10
+    The result is a view of the input whenever the input is C-ordered.
+    :param data_r: numpy array with dimensions (N, X*Y)
+    :param x: int, number of rows (w1 points) in each image
+    :param y: int, number of columns (w3 points) in each image
+    :return: numpy array with dimensions (X, Y, N)
+    """
+    return np.moveaxis(data_r.reshape(data_r.shape[0], x, y), 0, 2)
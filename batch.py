@@ -0,0 +1,145 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import analysis
+import fits
+import store
+import util
+
+
+"""Run the load / decompose / fit pipeline for many solvents in parallel."""
+
+T_SCALE = 1000  # Fit times in ps, as in the DEMO notebook
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+# Entries of a run_job result; stored results also hold the fit arrays, see store.FIT_ARRAYS
+RESULT_KEYS = ('components', 'projections', 'popt', 'pcov', 'w1', 'w3', 'tau2')
+
+
+def run_batch(solvents=util.SOLVENTS, analysis_types=('pca',), n_comps=(10,),
+              normalize=True, processes=None, blas_threads=1, store_dir=None):
+    """
+    Analyze every combination of solvent, analysis type and number of components.
+    :param solvents: list of solvent names known to util.loadSolvent
+    :param analysis_types: list of analysis types, any of 'pca', 'ica', 'fa'
+    :param n_comps: list of ints, numbers of components to generate
+    :param normalize: boolean, True to normalize data before doing analysis
+    :param processes: int, number of worker processes (default: one per CPU)
+    :param blas_threads: int, BLAS/OpenMP threads allowed in each worker
+                         keep processes * blas_threads <= number of cores
+    :param store_dir: optional results store directory (see store.py): results already
+                      saved there for the same data and options are loaded instead of
+                      recomputed, new results are saved
+    :return: dict keyed by (solvent, analysis_type, n_comp), each value a dict with
+             'components': (X, Y, n_comp) component images
+             'projections': (Z, n_comp) contribution of each component to each image
+             'popt', 'pcov': (n_comp, 3) and (n_comp, 3, 3) fits.my_exponential
+                             parameters and covariances of each component vs. tau2 in ps,
+                             NaN where the fit did not converge
+             'w1', 'w3', 'tau2': axes of the solvent data
+    """
+    jobs = [(solvent, analysis_type, n_comp)
+            for solvent in solvents
+            for analysis_type in analysis_types
+            for n_comp in n_comps]
+    # ICA and FA are iterative and dominate the run time: start them first
+    jobs.sort(key=lambda job: (job[1] == 'pca', -job[2]))
+
+    # Populate the solvent cache once so workers only memory-map it
+    for solvent in solvents:
+        util.loadSolvent(solvent)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=_limit_threads,
+                             initargs=(blas_threads,)) as pool:
+        futures = {job: pool.submit(run_job, job[0], job[1], job[2], normalize, store_dir)
+                   for job in jobs}
+        for job in jobs:
+            results[job] = futures[job].result()
+    return results
+
+
+def run_job(solvent, analysis_type='pca', n_comp=10, normalize=True, store_dir=None):
+    """
+    Load one solvent, decompose it and fit the dynamics of every component.
+    :param solvent: solvent name known to util.loadSolvent
+    :param analysis_type: 'pca', 'ica' or 'fa'
+    :param n_comp: int, number of components to generate
+    :param normalize: boolean, True to normalize data before doing analysis
+    :param store_dir: optional results store directory to load the result from, or save it to
+    :return: dict of results, see run_batch
+    """
+    data, w1, w3, tau2 = util.loadSolvent(solvent)
+    # Hashed once, for both the fit cache and the store index
+    digest = analysis.data_hash(data)
+    if store_dir is not None:
+        index = {'solvent': solvent, 'analysis_type': analysis_type, 'n_comp': n_comp,
+                 'data_hash': digest, 'options': {'normalize': normalize}}
+        found = store.find_results(store_dir, exact=True, **index)
+        if found:
+            saved = store.load_result(found[0], store_dir)
+            return {name: np.array(saved[name]) for name in RESULT_KEYS}
+    fit_object = analysis.do_analysis(data, normalize, n_comp, analysis_type, digest=digest)
+    comp = analysis.unreshape_image(fit_object.components_, data.shape[0], data.shape[1])
+    # Projections of the images as measured, as analysis.get_projections
+    proj = fit_object.transform(analysis.preprocess(data))
+    popt, pcov = fit_projections(tau2, proj)
+    result = {'components': np.array(comp), 'projections': proj,
+              'popt': popt, 'pcov': pcov,
+              'w1': np.array(w1), 'w3': np.array(w3), 'tau2': np.array(tau2)}
+    if store_dir is not None:
+        store.save_result(result, fit_object=fit_object, store_dir=store_dir, **index)
+    return result
+
+
+def run_joint(solvents=util.SOLVENTS, analysis_type='pca', n_comp=10, normalize=True):
+    """
+    Decompose all solvents with one shared set of components and fit every solvent's dynamics.
+    The solvents are regridded onto common w1 and w3 axes (see analysis.joint_analysis), so
+    the components, and their signs and order, are the same for every solvent.
+    :param solvents: list of solvent names known to util.loadSolvent
+    :param analysis_type: 'pca', 'ica' or 'fa'
+    :param n_comp: int, number of components to generate
+    :param normalize: boolean, True to normalize data before doing analysis
+    :return: dict keyed by (solvent, analysis_type, n_comp) like run_batch; every entry holds
+             the shared components and the common 'w1' and 'w3' axes
+    """
+    datasets = OrderedDict((solvent, util.loadSolvent(solvent)) for solvent in solvents)
+    fit_object, w1, w3, projections = analysis.joint_analysis(datasets, normalize, n_comp,
+                                                              analysis_type)
+    comp = np.array(analysis.unreshape_image(fit_object.components_, len(w1), len(w3)))
+    results = {}
+    for solvent, proj in projections.items():
+        tau2 = datasets[solvent][3]
+        popt, pcov = fit_projections(tau2, proj)
+        results[(solvent, analysis_type, n_comp)] = {
+            'components': comp, 'projections': proj, 'popt': popt, 'pcov': pcov,
+            'w1': w1, 'w3': w3, 'tau2': np.array(tau2)}
+    return results
+
+
+def fit_projections(tau2, proj):
+    """
+    Fit fits.my_exponential to the dynamics of every component.
+    :param tau2: list of times, Z x 1 numpy array
+    :param proj: projection of data onto components, Z x n_comp numpy array
+    :return: popt, (n_comp, 3) numpy array, NaN for the fits that did not converge
+             pcov, (n_comp, 3, 3) numpy array
+    """
+    return fits.batch_fit(fits.my_exponential, np.ravel(tau2) / T_SCALE, proj)
+
+
+def _limit_threads(n_threads):
+    """Cap BLAS/OpenMP threads in a worker so the pool does not oversubscribe cores."""
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    # Already-loaded BLAS libraries ignore the environment, limit them directly
+    global _thread_limits
+    _thread_limits = threadpool_limits(limits=n_threads)
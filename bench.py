@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+
+"""Benchmark the load, decompose, fit and render stages of the pipeline."""
+
+ANALYSIS_TYPES = ['pca', 'ica', 'fa']
+TOLERANCE = 0.2  # Fractional slowdown against the baseline reported as a regression
+
+
+def synthetic_cube(shape=(109, 109, 13), n_sources=3, noise=0.01, seed=0):
+    """
+    Make a synthetic 2D-IR-like stack: Gaussian peaks with exponential dynamics plus noise.
+    :param shape: (X, Y, Z) size of the stack
+    :param n_sources: int, number of peaks
+    :param noise: float, standard deviation of the added noise
+    :param seed: int, random seed
+    :return: data (X, Y, Z), w1 (X x 1), w3 (Y x 1), tau2 (Z x 1) numpy arrays
+    """
+    rng = np.random.RandomState(seed)
+    n_w1, n_w3, n_t = shape
+    w1 = np.linspace(1800, 1900, n_w1).reshape(-1, 1)
+    w3 = np.linspace(1790, 1890, n_w3).reshape(-1, 1)
+    tau2 = np.geomspace(100, 20000, n_t).reshape(-1, 1) - 100
+    data = noise * rng.standard_normal(shape)
+    for i in range(n_sources):
+        c1, c3 = rng.uniform(1820, 1880, 2)
+        img = np.exp(-((w1 - c1)**2 + (w3.T - c3)**2) / (2 * rng.uniform(5, 15)**2))
+        dynamics = rng.uniform(-1, 1) * np.exp(-tau2.ravel() / rng.uniform(500, 10000))
+        data += img[:, :, None] * dynamics
+    return data, w1, w3, tau2
+
+
+def measure(func, repeat=1):
+    """
+    Time a function and record its peak traced memory.
+    A first traced run measures memory (and warms up caches and imports), then the
+    function is timed over untraced runs, since tracing slows allocation-heavy code.
+    :param func: callable taking no arguments
+    :param repeat: int, number of timed runs; the fastest is reported
+    :return: dict with 'time' (s), 'peak_mb' (traced allocations) and 'result'
+    """
+    tracemalloc.start()
+    try:
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'time': best, 'peak_mb': peak / 2.0**20, 'result': result}
+
+
+def run(shape=(109, 109, 13), n_comps=(5, 10), analysis_types=ANALYSIS_TYPES,
+        solvents=(), repeat=3):
+    """
+    Run every benchmark stage and return the measurements.
+    :param shape: (X, Y, Z) size of the synthetic stack
+    :param n_comps: list of ints, numbers of components to benchmark
+    :param analysis_types: list of analysis types, any of 'pca', 'ica', 'fa'
+    :param solvents: list of bundled solvent names to benchmark loading and analysis of
+    :param repeat: int, timed runs per stage; the fastest is reported
+    :return: dict keyed by stage name, each value a dict with 'time', 'peak_mb',
+             'throughput_mb_s' (input megabytes per second) and 'error' if the stage failed
+    """
+    import analysis
+    import fits
+    import util
+
+    results = {}
+
+    def record(name, func, n_bytes):
+        try:
+            m = measure(func, repeat)
+        except Exception as err:
+            results[name] = {'error': type(err).__name__ + ': ' + str(err)}
+            return None
+        results[name] = {'time': m['time'], 'peak_mb': m['peak_mb'],
+                         'throughput_mb_s': n_bytes / 2.0**20 / m['time']}
+        return m['result']
+
+    data, w1, w3, tau2 = synthetic_cube(shape)
+    tag = 'x'.join(str(n) for n in shape)
+    cubes = [('synthetic_' + tag, data, w1, w3, tau2)]
+
+    # Loading: synthetic cube written as MAT-files laid out like a bundled solvent
+    workdir = tempfile.mkdtemp()
+    try:
+        from scipy.io import savemat
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        names = util.solventFiles('DMSO')
+        os.makedirs(os.path.dirname(names[0]))
+        for name, arr in zip(names, (w1, w3, tau2, data)):
+            savemat(name, {'x': arr})
+        record('load_cold_' + tag, lambda: util.loadSolvent('DMSO', cache=False), data.nbytes)
+        util.loadSolvent('DMSO')
+        record('load_cached_' + tag, lambda: util.loadSolvent('DMSO'), data.nbytes)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    for solvent in solvents:
+        loaded = record('load_' + solvent, lambda: util.loadSolvent(solvent, cache=False), 0)
+        if loaded is not None:
+            results['load_' + solvent]['throughput_mb_s'] = (
+                loaded[0].nbytes / 2.0**20 / results['load_' + solvent]['time'])
+            cubes.append((solvent,) + tuple(loaded))
+
+    for label, cube, w1, w3, tau2 in cubes:
+        for analysis_type in analysis_types:
+            for n_comp in n_comps:
+                name = '_'.join(['analysis', label, analysis_type, str(n_comp)])
+
+                def fit():
+                    analysis.clear_cache()
+                    return analysis.do_analysis(cube, True, n_comp, analysis_type)
+                record(name, fit, cube.nbytes)
+
+        proj = analysis.get_projections(cube, True, max(n_comps), 'pca')
+        t = tau2.ravel() / 1000.0
+        record('curve_fit_' + label, lambda: _curve_fit_all(t, proj), proj.nbytes)
+        record('batch_fit_' + label, lambda: fits.batch_fit(fits.my_exponential, t, proj),
+               proj.nbytes)
+        record('plot_image_' + label, lambda: _render(cube[:, :, 0], w1, w3),
+               cube[:, :, 0].nbytes)
+
+    results['max_rss_mb'] = _max_rss_mb()
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare stage times with a baseline.
+    :param results: dict from run
+    :param baseline: dict from run, e.g. loaded from a saved baseline file
+    :param tolerance: float, fractional slowdown reported as a regression
+    :return: list of (stage, baseline time, current time) for the regressed stages
+    """
+    regressions = []
+    for name, stage in sorted(results.items()):
+        old = baseline.get(name)
+        if not isinstance(stage, dict) or not isinstance(old, dict):
+            continue
+        if 'time' in stage and 'time' in old and stage['time'] > old['time'] * (1 + tolerance):
+            regressions.append((name, old['time'], stage['time']))
+    return regressions
+
+
+def report(results, baseline=None, stream=sys.stdout):
+    """
+    Print a table of the measurements, with the change against a baseline if given.
+    :param results: dict from run
+    :param baseline: optional dict from run
+    :param stream: file object to write to
+    """
+    stream.write('%-45s %10s %10s %12s %9s\n' % ('stage', 'time (s)', 'peak (MB)',
+                                                 'MB/s', 'vs base'))
+    for name, stage in sorted(results.items()):
+        if not isinstance(stage, dict):
+            continue
+        if 'error' in stage:
+            stream.write('%-45s %s\n' % (name, stage['error']))
+            continue
+        change = ''
+        if baseline and isinstance(baseline.get(name), dict) and 'time' in baseline[name]:
+            change = '%+.0f%%' % (100 * (stage['time'] / baseline[name]['time'] - 1))
+        stream.write('%-45s %10.4f %10.1f %12.1f %9s\n' % (
+            name, stage['time'], stage['peak_mb'], stage['throughput_mb_s'], change))
+    stream.write('max RSS: %.1f MB\n' % results['max_rss_mb'])
+
+
+def _curve_fit_all(t, proj):
+    """Fit fits.my_exponential to every projection column with scipy's curve_fit."""
+    from scipy.optimize import curve_fit
+    import fits
+    out = []
+    for i in range(proj.shape[1]):
+        y = proj[:, i]
+        p0 = np.abs(y[0] - y[-1]), 1, y[-1]
+        try:
+            out.append(curve_fit(fits.my_exponential, t, y, p0, maxfev=1000))
+        except RuntimeError:
+            out.append(None)
+    return out
+
+
+def _render(img, w1, w3):
+    """Draw one image with plot.plot_image on an off-screen figure."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    import plot
+    fig = Figure(figsize=(plot.FIG_SIZE, plot.FIG_SIZE))
+    canvas = FigureCanvasAgg(fig)
+    plot.plot_image(fig.add_subplot(1, 1, 1), img, w1, w3)
+    canvas.draw()
+
+
+def _max_rss_mb():
+    """Peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 2.0**20 if sys.platform == 'darwin' else rss / 2.0**10
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the spectro pipeline stages.')
+    parser.add_argument('--shape', type=int, nargs=3, default=[109, 109, 13],
+                        metavar=('X', 'Y', 'Z'), help='size of the synthetic stack')
+    parser.add_argument('--n-comp', type=int, nargs='+', default=[5, 10])
+    parser.add_argument('--analysis', nargs='+', default=ANALYSIS_TYPES,
+                        choices=ANALYSIS_TYPES)
+    parser.add_argument('--solvent', nargs='*', default=[],
+                        help='bundled solvents to benchmark as well')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', help='JSON file with baseline measurements')
+    parser.add_argument('--save', action='store_true',
+                        help='write the measurements to the baseline file')
+    args = parser.parse_args()
+
+    results = run(tuple(args.shape), args.n_comp, args.analysis, args.solvent, args.repeat)
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.baseline and args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if baseline:
+        regressions = compare(results, baseline)
+        for name, old, new in regressions:
+            print('REGRESSION %s: %.4f s -> %.4f s' % (name, old, new))
+        sys.exit(1 if regressions else 0)
@@ -1,7 +1,79 @@
-def getCenters(my_array):
+import numpy as np
+
+
+def getCenters(my_array, w1=None, w3=None, sign=1, method='parabolic',
+               threshold=0.5, w1_range=None):
     '''
     Computes the centers of data
- 
+
+    For every w1 row of every tau2 frame, finds the w3 position of the
+    peak with sub-grid interpolation around the largest point, then
+    fits the center line (w3 center vs. w1) of each frame. All rows
+    and frames are processed at once.
+
+    Parameters
+    ----------
+    my_array: numpy array, set of Z images, each X x Y (w1 x w3)
+    w1: w1 axis, X or X x 1 numpy array (default: row indices)
+    w3: w3 axis, Y or Y x 1 numpy array (default: column indices)
+    sign: 1 to track the positive (bleach) peak, -1 for the negative one
+    method: 'parabolic' for a 3-point parabola, 'gaussian' for a
+        3-point Gaussian (parabola through the log of the values)
+    threshold: only rows whose peak is at least this fraction of the
+        frame's peak are used for the center line
+    w1_range: optional (min, max) window of w1 for the center line
+
+    Returns
+    -------
+    centers: Z x X numpy array, w3 center of each w1 row of each frame
+    slopes: Z numpy array, center line slope of each frame, ready for
+        fits.batch_fit against tau2
+
     '''
+    data = sign * np.nan_to_num(np.asarray(my_array, dtype=float))
+    n_w1, n_w3 = data.shape[:2]
+    w1 = np.arange(n_w1, dtype=float) if w1 is None else np.ravel(w1)
+    w3 = np.arange(n_w3, dtype=float) if w3 is None else np.ravel(w3)
+
+    # Largest point of each row and its neighbours, all X x Z; peaks on
+    # the first or last point have no neighbour and are not interpolated
+    top = data.argmax(axis=1)
+    idx = np.clip(top, 1, n_w3 - 2)[:, None, :]
+    y0 = np.take_along_axis(data, idx - 1, axis=1)[:, 0, :]
+    y1 = np.take_along_axis(data, idx, axis=1)[:, 0, :]
+    y2 = np.take_along_axis(data, idx + 1, axis=1)[:, 0, :]
+    edge = top != idx[:, 0, :]
+
+    if method == 'gaussian':
+        positive = (y0 > 0) & (y1 > 0) & (y2 > 0)
+        tiny = np.finfo(float).tiny
+        ly0 = np.log(np.maximum(y0, tiny))
+        ly1 = np.log(np.maximum(y1, tiny))
+        ly2 = np.log(np.maximum(y2, tiny))
+        y0 = np.where(positive, ly0, y0)
+        y1 = np.where(positive, ly1, y1)
+        y2 = np.where(positive, ly2, y2)
+    elif method != 'parabolic':
+        raise ValueError('Unknown method: ' + str(method))
+
+    curvature = y0 - 2*y1 + y2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.where(curvature < 0, 0.5*(y0 - y2)/curvature, 0)
+    delta = np.where(edge, 0, np.clip(delta, -0.5, 0.5))
+    centers = np.interp(top + delta, np.arange(n_w3), w3).T
+
+    # Weighted least squares line through the selected rows of each frame
+    peak = data.max(axis=1).T
+    weights = (peak >= threshold * peak.max(axis=1)[:, None]) & (peak > 0)
+    if w1_range is not None:
+        weights &= (w1 >= min(w1_range)) & (w1 <= max(w1_range))
+    weights = weights.astype(float)
+    count = np.maximum(weights.sum(axis=1), 1)
+    x_mean = (weights * w1).sum(axis=1) / count
+    c_mean = (weights * centers).sum(axis=1) / count
+    dx = w1 - x_mean[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = ((weights * dx * (centers - c_mean[:, None])).sum(axis=1)
+                  / (weights * dx**2).sum(axis=1))
 
-    return
+    return centers, slopes
@@ -1,17 +1,16 @@
 import math
-import numpy as np
 from sklearn.decomposition import FactorAnalysis
 from sklearn.preprocessing import normalize
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 
+from analysis import preprocess, reconstruct, unreshape_image
 from fits import *
+from plot import draw_image
 from plot3d import *
 
 def doFactA(data,w1,w3,tau2,n_comp=10):
-    data_r = np.zeros((data.shape[2],data.shape[0]*data.shape[1]))
-    for i in range(data.shape[2]):
-        data_r[i] = np.nan_to_num(data[:,:,i]).ravel()
+    data_r = preprocess(data)
 
     # Standardize
 #    data_r = (data_r - np.mean(data_r,axis=0))/np.std(data_r,ddof=1,axis=0)
@@ -19,21 +18,16 @@ def doFactA(data,w1,w3,tau2,n_comp=10):
 
     facta = FactorAnalysis(n_components=n_comp)
     facta.fit(data_r)
-    comp = np.zeros((data.shape[0],data.shape[1],facta.components_.shape[0]))
-    for i in range(facta.components_.shape[0]):
-        comp[:,:,i] = facta.components_[i].reshape(data.shape[0],data.shape[1])
+    comp = unreshape_image(facta.components_,data.shape[0],data.shape[1])
 
     # Plot a series of components
-    w1grid, w3grid = np.meshgrid(w3, w1)
     fig, axarr = plt.subplots(3,3, figsize=(9,9), sharex=True, sharey=True)
     fig.subplots_adjust(hspace=0.3,wspace=0.4)
     for i in range(9):
         ax = axarr.flatten()[i]
         img = comp[:,:,i]
-        ax.pcolormesh(w1grid, w3grid, img)
+        draw_image(ax, img, w1, w3)
         ax.set_title('Component ' + str(i))
-        ax.set_xlim(w1grid.min(), w1grid.max())
-        ax.set_ylim(w3grid.min(), w3grid.max())
         plt.setp(ax.get_yticklabels(), visible=True)
         plt.setp(ax.get_xticklabels(), visible=True)
     plt.show()
@@ -46,18 +40,15 @@ def doFactA(data,w1,w3,tau2,n_comp=10):
     data_c = facta.transform(data_r)
 
     # Plot filtered contours
-    w1grid, w3grid = np.meshgrid(w3, w1)
     fig, axarr = plt.subplots(3,3, figsize=(9,9), sharex=True, sharey=True)
     fig.subplots_adjust(hspace=0.3,wspace=0.4)
+    filtered = reconstruct(facta,data_c,data.shape[:2],comp_nums=5,frames=range(0,18,2),mean=False)
     for j in range(9):
         ax = axarr.flatten()[j]
         i = 2*j
-        img = comp[:,:,0]*data_c[i,0] + comp[:,:,1]*data_c[i,1] + \
-            comp[:,:,2]*data_c[i,2] + comp[:,:,3]*data_c[i,3] + comp[:,:,4]*data_c[i,4] 
-        ax.pcolormesh(w1grid, w3grid, img)
+        img = filtered[:,:,j]
+        draw_image(ax, img, w1, w3)
         ax.set_title('Time ' + str(tau2[i]))
-        ax.set_xlim(w1grid.min(), w1grid.max())
-        ax.set_ylim(w3grid.min(), w3grid.max())
         plt.setp(ax.get_yticklabels(), visible=True)
         plt.setp(ax.get_xticklabels(), visible=True)
     plt.show()
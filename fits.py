@@ -1,5 +1,7 @@
 import numpy as np
 
+import profiling
+
 def my_exponential(t,a,b,c):
     return a*np.exp(-b*t) + c
 
@@ -12,3 +14,199 @@ def my_sine(t,a,b,c):
     return a*np.sin(b*t) + c
 
 
+def my_exponential_jac(t,a,b,c):
+    '''
+    Jacobian of my_exponential, parameters along the last axis
+    '''
+    e = np.exp(-b*t)
+    return np.stack(np.broadcast_arrays(e, -a*t*e, np.ones_like(e)), axis=-1)
+
+
+def my_double_exp_jac(t, a1, a2, b1, b2, c):
+    '''
+    Jacobian of my_double_exp, parameters along the last axis
+    '''
+    e1 = np.exp(-b1*t)
+    e2 = np.exp(-b2*t)
+    return np.stack(np.broadcast_arrays(e1, e2, -a1*t*e1, -a2*t*e2, np.ones_like(e1)),
+                    axis=-1)
+
+
+# Built-in models: analytic Jacobian and number of decay rates
+# (the remaining parameters enter linearly, see _varpro_guess)
+MODELS = {my_exponential: (my_exponential_jac, 1),
+          my_double_exp: (my_double_exp_jac, 2)}
+
+N_RATES = 40  # Grid size for the variable projection initial guess
+
+
+def batch_fit(model, t, Y, p0=None, max_iter=200, tol=1.49012e-8, weights=None):
+    '''
+    Fits a model to every column of Y at once with a vectorized
+    Levenberg-Marquardt solver.
+
+    For the built-in models (my_exponential, my_double_exp) the
+    Jacobian is analytic and, if p0 is not given, the initial guess
+    comes from variable projection: the amplitudes and offset are
+    solved by linear least squares over a grid of decay rates and the
+    best rates are kept for each column.
+
+    Parameters
+    ----------
+    model: fit function f(t, *params)
+    t: times, Z or Z x 1 numpy array (e.g. tau2 scaled to ps)
+    Y: data, Z or Z x n numpy array (e.g. projections onto n components)
+    p0: optional initial guess, either one list of parameters
+        shared by all columns or an n x p array; required for
+        models that are not built in
+    max_iter: maximum number of iterations
+    tol: relative change in residual sum of squares for convergence
+        (the ftol default of scipy.optimize.curve_fit)
+    weights: optional non-negative weight of every point, Z or Z x n
+        numpy array (e.g. bootstrap counts, or 0 to leave a point out);
+        the weighted sum of squared residuals is minimized
+
+    Returns
+    -------
+    popt: n x p array of fit parameters (p for 1-D Y), NaN for the
+        columns that did not converge within max_iter iterations or
+        whose damping grew without reducing the residuals
+    pcov: n x p x p array of parameter covariances, scaled by the
+        residual variance as in scipy.optimize.curve_fit (p x p for 1-D Y),
+        NaN for the columns that did not converge
+
+    '''
+    t = np.ravel(t).astype(float)
+    Y = np.asarray(Y, dtype=float)
+    squeeze = Y.ndim == 1
+    if squeeze:
+        Y = Y[:, None]
+    n = Y.shape[1]
+    # Square roots of the weights scale the residuals and Jacobian rows
+    if weights is None:
+        weights = np.ones(t.shape[0])
+    weights = np.broadcast_to(np.asarray(weights, dtype=float).reshape(t.shape[0], -1), Y.shape)
+    sw = np.sqrt(weights)
+
+    if model in MODELS:
+        jac = MODELS[model][0]
+    else:
+        jac = _numeric_jac(model)
+    if p0 is None:
+        if model not in MODELS:
+            raise ValueError('p0 is required for models that are not built in')
+        with profiling.stage('varpro_guess'):
+            P = _varpro_guess(t, Y, MODELS[model][1], sw)
+    else:
+        P = np.array(np.broadcast_to(np.asarray(p0, dtype=float), (n, np.shape(p0)[-1])))
+    p = P.shape[1]
+
+    def evaluate(P):
+        return model(t[:, None], *P.T)
+
+    with profiling.stage('batch_fit', model=getattr(model, '__name__', repr(model)), n_fits=n,
+                         n_points=t.shape[0]) as s:
+        r = sw * (Y - evaluate(P))
+        ssr = (r**2).sum(axis=0)
+        lam = np.full(n, 1e-3)
+        active = np.ones(n, dtype=bool)
+        done = np.zeros(n, dtype=bool)
+        it = -1
+        for it in range(max_iter):
+            J = np.moveaxis(jac(t[:, None], *P[active].T) * sw[:, active, None], 0, 1)  # n x Z x p
+            JTJ = np.einsum('nzi,nzj->nij', J, J)
+            JTr = np.einsum('nzi,zn->ni', J, r[:, active])
+            diag = np.einsum('nii->ni', JTJ)
+            A = JTJ + (lam[active, None] * diag)[:, :, None] * np.eye(p)
+            try:
+                step = np.linalg.solve(A, JTr[:, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = np.einsum('nij,nj->ni', np.linalg.pinv(A), JTr)
+
+            P_new = P.copy()
+            P_new[active] += step
+            r_new = sw[:, active] * (Y[:, active] - evaluate(P_new[active]))
+            ssr_new = (r_new**2).sum(axis=0)
+
+            idx = np.flatnonzero(active)
+            better = np.isfinite(ssr_new) & (ssr_new <= ssr[idx])
+            good = idx[better]
+            P[good] = P_new[good]
+            r[:, good] = r_new[:, better]
+            converged = better & (ssr[idx] - ssr_new <= tol * ssr[idx])
+            ssr[good] = ssr_new[better]
+            done[idx[converged]] = True
+            lam[good] /= 10
+            lam[idx[~better]] *= 10
+            active[idx[converged | (lam[idx] > 1e10)]] = False
+            if not active.any():
+                break
+
+        s.add(n_iter=it + 1, failed=int(n - done.sum()))
+        J = np.moveaxis(jac(t[:, None], *P.T) * sw[:, :, None], 0, 1)
+        JTJ = np.einsum('nzi,nzj->nij', J, J)
+        dof = np.maximum(weights.sum(axis=0) - p, 1)
+        pcov = np.linalg.pinv(JTJ) * (ssr / dof)[:, None, None]
+        P[~done] = np.nan
+        pcov[~done] = np.nan
+
+    if squeeze:
+        return P[0], pcov[0]
+    return P, pcov
+
+
+def _varpro_guess(t, Y, n_rates, sw=None):
+    '''
+    Initial guess for sums of n_rates exponentials plus an offset.
+    Tries every combination of rates from a log-spaced grid, solving the
+    linear parameters by least squares, and keeps the best per column.
+    With sw (Z x n square roots of the weights, as in batch_fit) the
+    least squares are weighted; columns sharing one set of weights are
+    solved together, otherwise every column has its own normal equations.
+    Returns an n x p array ordered as the built-in model parameters.
+    '''
+    span = t.max() - t.min()
+    dt = np.diff(np.unique(t))
+    step = dt.min() if dt.size else span
+    grid = np.logspace(np.log10(0.1 / span), np.log10(2.0 / step), N_RATES)
+
+    if n_rates == 1:
+        rates = grid[:, None]
+    else:
+        i, j = np.triu_indices(N_RATES, k=1)
+        rates = np.stack([grid[i], grid[j]], axis=1)
+
+    # G x Z x (n_rates + 1) basis: one exponential per rate and a constant
+    basis = np.concatenate([np.exp(-rates[:, None, :] * t[None, :, None]),
+                            np.ones((rates.shape[0], t.shape[0], 1))], axis=2)
+    if sw is None or np.all(sw == sw[:, :1]):
+        s = np.ones((t.shape[0], 1)) if sw is None else sw[:, :1]
+        coef = np.linalg.pinv(s * basis) @ (s * Y)  # G x (n_rates + 1) x n
+    else:
+        w = sw**2
+        A = np.einsum('gzi,zn,gzj->gnij', basis, w, basis)
+        b = np.einsum('gzi,zn->gni', basis, w * Y)
+        coef = np.einsum('gnij,gnj->gin', np.linalg.pinv(A), b)
+        s = sw
+    ssr = (((basis @ coef - Y) * s)**2).sum(axis=1)  # G x n
+    best = ssr.argmin(axis=0)
+
+    amps = coef[best, :n_rates, np.arange(Y.shape[1])]
+    offset = coef[best, n_rates, np.arange(Y.shape[1])]
+    return np.column_stack([amps, rates[best], offset])
+
+
+def _numeric_jac(model, eps=1e-8):
+    '''
+    Forward-difference Jacobian for models without an analytic one.
+    '''
+    def jac(t, *params):
+        f0 = model(t, *params)
+        cols = []
+        for k in range(len(params)):
+            h = eps * np.maximum(np.abs(params[k]), 1)
+            shifted = list(params)
+            shifted[k] = params[k] + h
+            cols.append((model(t, *shifted) - f0) / h)
+        return np.stack(cols, axis=-1)
+    return jac
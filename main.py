@@ -1,35 +1,160 @@
-from util import *
-from pca import *
-from ica import *
-from facta import *
-from plot3d import *
-import matplotlib.pyplot as plt
+import argparse
+import json
+import sys
 
-if __name__ == '__main__':
-    W1_NAME = '2D-IR-Data_SNP_NO_Brookes_JPCB_2013/DMSO/w1.mat'
-    W3_NAME = '2D-IR-Data_SNP_NO_Brookes_JPCB_2013/DMSO/w3_corrected_DMSO.mat'
-    TAU2_NAME = '2D-IR-Data_SNP_NO_Brookes_JPCB_2013/DMSO/Tau_2_DMSO.mat'
-    DATA_ARRAY_NAME = '2D-IR-Data_SNP_NO_Brookes_JPCB_2013/DMSO/Matexp_DMSO.mat'
-
-    xw1 = loadData(W1_NAME)
-    xw3 = loadData(W3_NAME)
-    xt2 = loadData(TAU2_NAME)
-    xdata = loadData(DATA_ARRAY_NAME)
-
-    data, vec_list = matchDims(xdata,[xw1,xw3,xt2])
-    w1 = vec_list[0]
-    w3 = vec_list[1]
-    tau2 = vec_list[2]
-
-    doFactA(data,w1,w3,tau2)
-#    doICA(data,w1,w3,tau2)
-#    doPCA(data,w1,w3,tau2)
-#    surf3d(w1,w3,data[:,:,1])
-        
-#    # create the plot
-#    X,Y = np.meshgrid(w3,w1)
-#    levels = np.linspace(-1,1,25)
-#    C = plt.contourf(X,Y,data[:,:,1],levels)
-#    plt.colorbar(C,shrink=0.8,extend='both')
-#    plt.show()
+import util
+
+
+"""
+Command-line entry point: decompose solvents, fit their dynamics and optionally save figures.
+Options come from the command line or a JSON config file (keys are the long option names),
+with the command line taking precedence, e.g.
+    python main.py --solvent DMSO H2O --analysis pca ica --n-comp 5 10 --output figures
+Only numpy is imported at startup; scikit-learn and matplotlib are imported by the stages
+that need them, so compute-only runs never load the plotting stack.
+"""
+
+ANALYSIS_TYPES = ['pca', 'ica', 'fa']
+DEFAULTS = {'solvent': ['DMSO'], 'analysis': ['pca'], 'n_comp': [10], 'normalize': True,
+            'joint': False, 'store': None, 'output': None, 'format': ['png'],
+            'processes': None, 'blas_threads': 1, 'profile': None}
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line, filling in options from the config file given with --config.
+    :param argv: list of arguments (default: sys.argv[1:])
+    :return: argparse.Namespace with the keys of DEFAULTS
+    """
+    parser = argparse.ArgumentParser(description='Decompose 2D-IR data and fit the dynamics '
+                                                 'of the components.')
+    parser.add_argument('--config', help='JSON file of options, keyed by long option name')
+    parser.add_argument('--solvent', nargs='+', choices=util.SOLVENTS)
+    parser.add_argument('--analysis', nargs='+', choices=ANALYSIS_TYPES)
+    parser.add_argument('--n-comp', type=int, nargs='+', help='numbers of components')
+    parser.add_argument('--no-normalize', dest='normalize', action='store_false',
+                        help='do not scale each image by its peak before the fit')
+    parser.add_argument('--joint', action='store_true',
+                        help='fit one set of components shared by all solvents')
+    parser.add_argument('--store', help='results store directory: reuse saved results and '
+                                        'save new ones (not used with --joint)')
+    parser.add_argument('--output', help='directory to write component and fit figures to')
+    parser.add_argument('--format', nargs='+', help='figure file formats, e.g. png pdf')
+    parser.add_argument('--processes', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--blas-threads', type=int, help='BLAS threads in each worker')
+    parser.add_argument('--profile', help='write the timing of the stages run in this process '
+                                          'to this file (.json records, otherwise collapsed '
+                                          'stacks for flame graphs)')
+    parser.set_defaults(**DEFAULTS)
+
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        try:
+            parser.set_defaults(**load_config(args.config, parser))
+        except (OSError, ValueError) as err:
+            parser.error('cannot read config ' + args.config + ': ' + str(err))
+    return parser.parse_args(argv)
+
+
+def load_config(filename, parser):
+    """
+    Read options from a JSON config file, e.g. {"solvent": ["DMSO"], "n-comp": [5, 10]}.
+    Keys are the long option names of parser, and values are converted and checked like
+    command-line arguments; flags take true or false, e.g. {"no-normalize": true}.
+    :param filename: path of the config file
+    :param parser: argparse.ArgumentParser of the command line
+    :return: dict of options keyed like DEFAULTS
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError('expected a JSON object of options')
+    options = {}
+    for key, value in config.items():
+        action = parser._option_string_actions.get('--' + key)
+        if action is None or action.dest in ('config', 'help'):
+            raise ValueError('unknown option: ' + key)
+        if action.nargs == 0:
+            # Flags: true applies the flag, e.g. store_false for "no-normalize"
+            if not isinstance(value, bool):
+                raise ValueError(key + ' must be true or false')
+            options[action.dest] = action.const if value else action.default
+            continue
+        if value is None and action.nargs is None:
+            options[action.dest] = None
+            continue
+        if isinstance(value, list) and action.nargs is None:
+            raise ValueError(key + ' takes a single value')
+        # Single values are accepted for the options that take lists
+        values = value if isinstance(value, list) else [value]
+        if not values:
+            raise ValueError(key + ' needs at least one value')
+        checked = []
+        for item in values:
+            # Converted from text, as on the command line, so e.g. 2.5 is not an int
+            if isinstance(item, (bool, list, dict)) or item is None:
+                raise ValueError('invalid value for ' + key + ': ' + json.dumps(item))
+            try:
+                item = (action.type or str)(str(item))
+            except ValueError:
+                raise ValueError('invalid value for ' + key + ': ' + json.dumps(item))
+            if action.choices is not None and item not in action.choices:
+                raise ValueError('invalid choice for ' + key + ': ' + json.dumps(item) +
+                                 ' (choose from ' + ', '.join(map(str, action.choices)) + ')')
+            checked.append(item)
+        options[action.dest] = checked if action.nargs is not None else checked[0]
+    return options
 
+
+def run(args):
+    """
+    Run the pipeline for parsed options.
+    :param args: argparse.Namespace from parse_args
+    :return: dict keyed by (solvent, analysis_type, n_comp), see batch.run_batch
+    """
+    import batch
+    if args.joint:
+        results = {}
+        for analysis_type in args.analysis:
+            for n_comp in args.n_comp:
+                results.update(batch.run_joint(args.solvent, analysis_type, n_comp,
+                                               args.normalize))
+    else:
+        results = batch.run_batch(args.solvent, args.analysis, args.n_comp, args.normalize,
+                                  args.processes, args.blas_threads, args.store)
+    if args.output:
+        import report
+        report.render_report(results, args.output, args.format, args.processes)
+    return results
+
+
+def summarize(results, stream=sys.stdout):
+    """
+    Print the lifetime of every component of every result.
+    :param results: dict from run
+    :param stream: file object to write to
+    """
+    stream.write('%-6s %-4s %6s %5s %14s\n' % ('solv', 'type', 'n_comp', 'comp', 'lifetime (ps)'))
+    for (solvent, analysis_type, n_comp), result in sorted(results.items()):
+        for i, rate in enumerate(result['popt'][:, 1]):
+            stream.write('%-6s %-4s %6d %5d %14.4g\n' % (solvent, analysis_type, n_comp, i + 1,
+                                                        1 / rate))
+
+
+def main(argv=None):
+    """Parse the command line, run the pipeline and print the lifetimes."""
+    args = parse_args(argv)
+    import profiling
+    if args.profile:
+        profiling.enable()
+    results = run(args)
+    summarize(results)
+    if args.profile:
+        if args.profile.endswith('.json'):
+            profiling.write_json(args.profile)
+        else:
+            profiling.write_collapsed(args.profile)
+
+
+if __name__ == '__main__':
+    main()
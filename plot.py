@@ -1,14 +1,26 @@
+import os
+import shutil
+import subprocess
+from collections import OrderedDict
+
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 matplotlib.rcParams.update({'font.size': 14})
 matplotlib.rcParams.update({'mathtext.default': 'regular'})
 import fits
+import profiling
 
 # "Plot" functions return axes objects
 # "Show" functions display plots
 
 FIG_SIZE = 4  # Default size for single-panel figures
+RASTER_IMAGES = True  # Draw images on uniform axes with imshow instead of pcolormesh
+UNIFORM_TOL = 0.01  # Largest deviation from uniform spacing, as a fraction of a pixel
+GRID_CACHE_SIZE = 16  # Number of (w1, w3) axis pairs kept in the grid cache
+_grid_cache = OrderedDict()
 
 
 def plot_image(ax, img, w1, w3, colormap='jet'):
@@ -21,17 +33,99 @@ def plot_image(ax, img, w1, w3, colormap='jet'):
     :param colormap: optional colormap to use
     :return: the input axes object with the input image plotted on it
     """
-    w1grid, w3grid = np.meshgrid(w3, w1)
-    ax.pcolormesh(w1grid, w3grid, img,
-                  vmin=-np.abs(img).max(), vmax=np.abs(img).max(), cmap=colormap)
+    peak = np.abs(img).max()
+    draw_image(ax, img, w1, w3, vmin=-peak, vmax=peak, cmap=colormap)
+    _label_axes(ax)
+    return ax
+
+
+def _label_axes(ax):
+    """Label the axes of an image plot with the frequency axes."""
     ax.set_xlabel('$\omega_1/2\pi c\ (cm^{-1})$', fontsize=14)
     ax.set_ylabel('$\omega_3/2\pi c\ (cm^{-1})$', fontsize=14)
-    ax.set_xlim(w1grid.min(), w1grid.max())
-    ax.set_ylim(w3grid.min(), w3grid.max())
-    return ax
 
 
-def show_data(data, w1, w3, tau2, time):
+def draw_image(ax, img, w1, w3, **kwargs):
+    """
+    Draw an image on its frequency axes and return the artist.
+    Uniformly spaced axes are drawn as a raster (imshow), others with pcolormesh.
+    :param ax: axes object
+    :param img: image to plot, X x Y numpy array
+    :param w1: x-axis, X x 1 numpy array
+    :param w3: y-axis, Y x 1 numpy array
+    :param kwargs: passed on to imshow or pcolormesh, e.g. cmap, vmin, vmax
+    :return: AxesImage or QuadMesh artist, see update_image
+    """
+    grid = image_grid(w1, w3)
+    if RASTER_IMAGES and grid['extent'] is not None:
+        artist = ax.imshow(img, extent=grid['extent'], origin='lower', aspect='auto',
+                           interpolation='nearest', **kwargs)
+    else:
+        w1grid, w3grid = grid['grids']
+        artist = ax.pcolormesh(w1grid, w3grid, img, **kwargs)
+    ax.set_xlim(grid['xlim'])
+    ax.set_ylim(grid['ylim'])
+    return artist
+
+
+def update_image(artist, img, symmetric=True):
+    """
+    Replace the image drawn by draw_image or plot_image in place, e.g. for animation.
+    :param artist: AxesImage or QuadMesh returned by draw_image (or ax.images[-1])
+    :param img: new image, X x Y numpy array of the same shape
+    :param symmetric: boolean, True to rescale colors to +/- the peak absolute value
+    :return: the artist
+    """
+    if hasattr(artist, 'get_extent'):
+        artist.set_data(img)
+    else:
+        artist.set_array(img.ravel())
+    if symmetric:
+        peak = np.abs(img).max()
+        artist.set_clim(-peak, peak)
+    return artist
+
+
+def image_grid(w1, w3):
+    """
+    Return the cached plotting grid for a pair of frequency axes.
+    :param w1: x-axis, X x 1 numpy array
+    :param w3: y-axis, Y x 1 numpy array
+    :return: dict with
+             'grids': (w1grid, w3grid) from np.meshgrid(w3, w1), for pcolormesh
+             'extent': imshow extent, or None if the axes are not uniformly spaced
+             'xlim', 'ylim': axis limits
+    """
+    w1 = np.ravel(w1)
+    w3 = np.ravel(w3)
+    key = (w1.tobytes(), w3.tobytes())
+    if key in _grid_cache:
+        _grid_cache.move_to_end(key)
+        return _grid_cache[key]
+
+    extent = None
+    if _is_uniform(w1) and _is_uniform(w3):
+        d1 = (w1[-1] - w1[0]) / (len(w1) - 1)
+        d3 = (w3[-1] - w3[0]) / (len(w3) - 1)
+        extent = (w3[0] - d3/2, w3[-1] + d3/2, w1[0] - d1/2, w1[-1] + d1/2)
+    grid = {'grids': np.meshgrid(w3, w1), 'extent': extent,
+            'xlim': (w3.min(), w3.max()), 'ylim': (w1.min(), w1.max())}
+
+    _grid_cache[key] = grid
+    while len(_grid_cache) > GRID_CACHE_SIZE:
+        _grid_cache.popitem(last=False)
+    return grid
+
+
+def _is_uniform(w):
+    """Return True if the axis has at least 2 points with uniform spacing."""
+    if len(w) < 2:
+        return False
+    step = (w[-1] - w[0]) / (len(w) - 1)
+    return step != 0 and np.abs(np.diff(w) - step).max() <= UNIFORM_TOL * abs(step)
+
+
+def show_data(data, w1, w3, tau2, time, filename=None):
     """
     Show a plot of the first image from the input data with time after the input time.
     :param data: numpy array, set of Z images, each X x Y
@@ -40,16 +134,17 @@ def show_data(data, w1, w3, tau2, time):
     :param tau2: list of times, Z x 1 numpy array
     :param time: target time
                  This function finds the first image after the target time.
+    :param filename: optional file to save the figure to (e.g. .png or .pdf) instead of showing it
     :return displays a figure
     """
     fig, ax = plt.subplots(figsize=(FIG_SIZE, FIG_SIZE))
     i = time_to_index(tau2, time)
     ax = plot_image(ax, data[:, :, i], w1, w3)
     ax.set_title("t = " + str(tau2[i][0]) + " fs", fontsize=14)
-    plt.show()
+    _show(fig, filename)
 
 
-def show_3_data(data, w1, w3, tau2, times=[0, 0, 0]):
+def show_3_data(data, w1, w3, tau2, times=[0, 0, 0], filename=None):
     """
     Show 3 plots of images from the input data corresponding to the input times.
     :param data: numpy array, set of Z images, each X x Y
@@ -57,15 +152,16 @@ def show_3_data(data, w1, w3, tau2, times=[0, 0, 0]):
     :param w3: y-axis, Y x 1 numpy array
     :param tau2: list of times, Z x 1 numpy array
     :param times: list of 3 target times in fs
+    :param filename: optional file to save the figure to (e.g. .png or .pdf) instead of showing it
     :return: displays a figure
     """
     fig, axarr = plt.subplots(1, 3, sharex=True, sharey=True)
     fig.subplots_adjust(hspace=0.3, wspace=0.5)
     fig.set_size_inches(11, 3)
 
-    w1grid, w3grid = np.meshgrid(w3, w1)
-    plt.setp(axarr.flat, adjustable='box-forced',
-             aspect=(w1grid.max()-w1grid.min()) / (w3grid.max()-w3grid.min()))
+    grid = image_grid(w1, w3)
+    plt.setp(axarr.flat, adjustable='box',
+             aspect=(grid['xlim'][1]-grid['xlim'][0]) / (grid['ylim'][1]-grid['ylim'][0]))
 
     for i in range(3):
         ax = axarr.flatten()[i]
@@ -74,39 +170,43 @@ def show_3_data(data, w1, w3, tau2, times=[0, 0, 0]):
         ax.set_title("t = " + str(tau2[time_i][0]) + " fs")
         plt.setp(ax.get_yticklabels(), visible=True)
         plt.setp(ax.get_xticklabels(), visible=True)
+    if filename is not None:
+        _show(fig, filename)
 
 
-def show_component(comp, w1, w3, comp_num):
+def show_component(comp, w1, w3, comp_num, filename=None):
     """
     Show a plot of the specified component image.
     :param comp: numpy array, set of n_comp images, each X x Y
     :param w1: x-axis, X x 1 numpy array
     :param w3: y-axis, Y x 1 numpy array
     :param comp_num: component number to plot (1 through n_comp)
+    :param filename: optional file to save the figure to (e.g. .png or .pdf) instead of showing it
     :return: displays a figure
     """
     fig, ax = plt.subplots(figsize=(FIG_SIZE, FIG_SIZE))
     ax = plot_image(ax, comp[:, :, comp_num-1], w1, w3, 'bwr')
     ax.set_title("Component " + str(comp_num), fontsize=14)
-    plt.show()
+    _show(fig, filename)
 
 
-def show_3_components(comp, w1, w3, comp_nums=[1,2,3]):
+def show_3_components(comp, w1, w3, comp_nums=[1,2,3], filename=None):
     """
     Show a plot of the first 3 component images.
     :param comp: numpy array, set of n_comp images, each X x Y
     :param w1: x-axis, X x 1 numpy array
     :param w3: y-axis, Y x 1 numpy array
     :param comp_nums: list of 3 component numbers
+    :param filename: optional file to save the figure to (e.g. .png or .pdf) instead of showing it
     :return: displays a figure
     """
     fig, axarr = plt.subplots(1, 3, sharex=True, sharey=True)
     fig.subplots_adjust(hspace=0.3, wspace=0.5)
     fig.set_size_inches(11, 3)
 
-    w1grid, w3grid = np.meshgrid(w3, w1)
-    plt.setp(axarr.flat, adjustable='box-forced',
-             aspect=(w1grid.max()-w1grid.min()) / (w3grid.max()-w3grid.min()))
+    grid = image_grid(w1, w3)
+    plt.setp(axarr.flat, adjustable='box',
+             aspect=(grid['xlim'][1]-grid['xlim'][0]) / (grid['ylim'][1]-grid['ylim'][0]))
 
     for i in range(3):
         ax = axarr.flatten()[i]
@@ -115,6 +215,8 @@ def show_3_components(comp, w1, w3, comp_nums=[1,2,3]):
         ax.set_title("Component " + str(comp_i+1))
         plt.setp(ax.get_yticklabels(), visible=True)
         plt.setp(ax.get_xticklabels(), visible=True)
+    if filename is not None:
+        _show(fig, filename)
 
 
 def plot_contribution(ax, tau2, proj, comp_num=1):
@@ -127,25 +229,26 @@ def plot_contribution(ax, tau2, proj, comp_num=1):
     :return: axes object with scatter plot of projection vs time
     """
     buffer = tau2[-1][0]/100
-    ax.plot([-buffer, tau2[-1] + buffer], [0, 0], c='black')  # zero line
+    ax.plot([-buffer, tau2[-1][0] + buffer], [0, 0], c='black')  # zero line
     ax.scatter(tau2, proj[:, comp_num-1])
     ax.set_xlabel("Time (fs)", fontsize=14)
-    ax.set_xlim(-buffer, tau2[-1] + buffer)
+    ax.set_xlim(-buffer, tau2[-1][0] + buffer)
     ax.set_title("Component " + str(comp_num), fontsize=14)
     return ax
 
 
-def show_contribution(tau2, proj, comp_num):
+def show_contribution(tau2, proj, comp_num, filename=None):
     """
     Show scatter plot of dynamics for specified component.
     :param tau2: list of times, Z x 1 numpy array
     :param proj: projection of data onto components, Z x n_comp numpy array
     :param comp_num: component to plot
+    :param filename: optional file to save the figure to (e.g. .png or .pdf) instead of showing it
     :return: shows a figure
     """
     fig, ax = plt.subplots(figsize=(FIG_SIZE, FIG_SIZE))
     ax = plot_contribution(ax, tau2, proj, comp_num)
-    plt.show()
+    _show(fig, filename)
 
 
 def plot_exp_fit(ax, popt, tau2):
@@ -164,7 +267,7 @@ def plot_exp_fit(ax, popt, tau2):
     return ax
 
 
-def show_exp_fit(tau2, proj, comp_num, popt, T_SCALE):
+def show_exp_fit(tau2, proj, comp_num, popt, T_SCALE, filename=None):
     """
     Show scatter plot and exponential fit for dynamics for specified component.
     :param tau2: list of times, Z x 1 numpy array
@@ -174,6 +277,7 @@ def show_exp_fit(tau2, proj, comp_num, popt, T_SCALE):
                  must be from either fits.my_exponential or fits.my_double_exp
     :param T_SCALE: scaling parameter used for fitting
                     1000 for ps, 1 for fs
+    :param filename: optional file to save the figure to (e.g. .png or .pdf) instead of showing it
     :return: shows a figure
     """
     fig, ax = plt.subplots(figsize=(FIG_SIZE, FIG_SIZE))
@@ -189,13 +293,153 @@ def show_exp_fit(tau2, proj, comp_num, popt, T_SCALE):
     ax.set_xlabel("Time " + time_units)
 
     buffer = tau2[-1][0]/T_SCALE / 100
-    ax.set_xlim(-buffer, tau2[-1]/T_SCALE + buffer)
-    plt.show()
+    ax.set_xlim(-buffer, tau2[-1][0]/T_SCALE + buffer)
+    _show(fig, filename)
+
+
+def save_movie(data, w1, w3, tau2, filename, comp=None, proj=None, comp_nums=None,
+               fps=10, dpi=100, colormap='jet'):
+    """
+    Save a movie of every tau2 frame of the data, or of the data rebuilt from components.
+    Frames are drawn by updating a single image artist over a cached background (blitting)
+    and piped to the writer one at a time, so memory use does not grow with the movie length.
+    :param data: numpy array, set of Z images, each X x Y (may be None if comp is given)
+    :param w1: x-axis, X x 1 numpy array
+    :param w3: y-axis, Y x 1 numpy array
+    :param tau2: list of times, Z x 1 numpy array
+    :param filename: output file, any format ffmpeg can write (e.g. .mp4 or .gif)
+                     without ffmpeg only .gif is supported, and frames are then kept in memory
+    :param comp: optional numpy array, set of n_comp component images, each X x Y
+    :param proj: projection of data onto components, Z x n_comp numpy array (with comp)
+    :param comp_nums: optional list of component numbers (1 through n_comp) to rebuild from
+    :param fps: frames per second
+    :param dpi: resolution of the frames
+    :param colormap: optional colormap to use
+    :return: the output filename
+    """
+    if comp is not None:
+        sel = np.arange(comp.shape[2]) if comp_nums is None else np.asarray(comp_nums) - 1
+        comp = comp[:, :, sel]
+        proj = proj[:, sel]
+        n_frames = proj.shape[0]
+        frame = lambda i: np.dot(comp, proj[i])
+    else:
+        n_frames = data.shape[2]
+        frame = lambda i: np.nan_to_num(data[:, :, i])
+    # Colour scale from one frame at a time, the movie is never held in memory
+    peak = max(np.abs(frame(i)).max(initial=0) for i in range(n_frames)) or 1
+
+    fig = Figure(figsize=(FIG_SIZE + 1, FIG_SIZE), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    fig.subplots_adjust(left=0.2, bottom=0.17)
+    artist = draw_image(ax, frame(0), w1, w3, vmin=-peak, vmax=peak, cmap=colormap)
+    _label_axes(ax)
+    title = ax.set_title("", fontsize=14)
+    artist.set_animated(True)
+    title.set_animated(True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    width, height = canvas.get_width_height()
+    with profiling.stage('save_movie', filename=filename, n_frames=n_frames):
+        writer = _MovieWriter(filename, width, height, fps)
+        try:
+            for i in range(n_frames):
+                canvas.restore_region(background)
+                update_image(artist, frame(i), symmetric=False)
+                title.set_text("t = " + str(np.ravel(tau2)[i]) + " fs")
+                ax.draw_artist(artist)
+                ax.draw_artist(title)
+                writer.write(canvas.buffer_rgba())
+        finally:
+            writer.close()
+    return filename
+
+
+class _MovieWriter(object):
+    """
+    Stream raw RGBA frames to an ffmpeg process (or collect them for a Pillow GIF).
+    """
+
+    def __init__(self, filename, width, height, fps):
+        self.filename = filename
+        self.size = (width, height)
+        self.fps = fps
+        self.frames = None
+        self.proc = None
+        ffmpeg = shutil.which(matplotlib.rcParams['animation.ffmpeg_path'])
+        if ffmpeg is not None:
+            cmd = [ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '%dx%d' % self.size,
+                   '-r', str(fps), '-i', 'pipe:0']
+            if not filename.lower().endswith('.gif'):
+                # Most codecs need even frame sizes and a 4:2:0 pixel format
+                cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p']
+            self.proc = subprocess.Popen(cmd + [filename], stdin=subprocess.PIPE)
+        elif filename.lower().endswith('.gif'):
+            self.frames = []
+        else:
+            raise RuntimeError('ffmpeg is required to write ' + os.path.basename(filename))
+
+    def write(self, rgba):
+        if self.proc is not None:
+            self.proc.stdin.write(rgba)
+        else:
+            from PIL import Image
+            self.frames.append(Image.frombuffer('RGBA', self.size, bytes(rgba)).convert('P'))
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise RuntimeError('ffmpeg failed to write ' + self.filename)
+        elif self.frames:
+            self.frames[0].save(self.filename, save_all=True, append_images=self.frames[1:],
+                                duration=1000.0 / self.fps, loop=0)
+
+
+def _show(fig, filename=None):
+    """Display a figure, or save it to filename and close it when exporting."""
+    if filename is None:
+        plt.show()
+    else:
+        with profiling.stage('savefig', filename=filename):
+            fig.savefig(filename)
+        plt.close(fig)
+
+
+def time_to_index(tau2, target, mode='ceil'):
+    """
+    Return the index of tau2 matching each target time, using a binary search.
+    :param tau2: list of times, Z or Z x 1 numpy array
+    :param target: target time, or array of target times
+    :param mode: 'ceil' for the first time at or after the target (default),
+                 'floor' for the last time at or before the target,
+                 'nearest' for the closest time
+                 targets out of range map to the first or last index
+    :return: int index, or numpy array of indices with the shape of target
+    """
+    times = np.ravel(tau2)
+    order = None
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+    target = np.asarray(target)
 
+    if mode == 'ceil':
+        idx = np.searchsorted(times, target, side='left')
+    elif mode == 'floor':
+        idx = np.searchsorted(times, target, side='right') - 1
+    elif mode == 'nearest':
+        idx = np.clip(np.searchsorted(times, target, side='left'), 1, len(times) - 1)
+        idx = idx - (target - times[idx - 1] <= times[idx] - target)
+    else:
+        raise ValueError('Unknown mode: ' + str(mode))
+    idx = np.clip(idx, 0, len(times) - 1)
 
-def time_to_index(tau2, target):
-    """Return the index after where target time would occur in tau2"""
-    for time in tau2:
-        if time >= target:
-            return np.where(tau2 == time)[0][0]
-    return tau2.shape[0] - 1
\ No newline at end of file
+    if order is not None:
+        idx = order[idx]
+    if idx.ndim == 0:
+        return int(idx)
+    return idx
@@ -4,19 +4,29 @@ import matplotlib.ticker as ticker
 from matplotlib import cm
 from mpl_toolkits.mplot3d import Axes3D
 
-def surf3d(x,y,Z,window_title='Figure',ax_title='',fig='None',azim=-50,elev=25):
+from plot import image_grid
+
+MAX_POLYS = 5000  # Default polygon budget for surface plots
+
+def surf3d(x,y,Z,window_title='Figure',ax_title='',fig='None',azim=-50,elev=25,
+           max_polys=MAX_POLYS,smooth=True):
     '''
     Performs 3d surface plot for x,y,Z data
+
+    Large grids are decimated to about max_polys polygons, by block
+    averaging (smooth=True) or plain striding (smooth=False), so the
+    drawing time does not depend on the grid size.
     '''
-    X,Y = np.meshgrid(y,x)
+    X,Y,Z = decimate(x,y,Z,max_polys,smooth)
     if(fig=='None'):
         fig = plt.figure(figsize=(12,6))
-    fig.canvas.set_window_title(window_title)
-    ax = fig.gca(projection='3d')
+    if fig.canvas.manager is not None:
+        fig.canvas.manager.set_window_title(window_title)
+    ax = fig.add_subplot(projection='3d')
 
     TICK_LIMIT = 5
 
-    surf = ax.plot_surface(X,Y,Z,rstride=2,cstride=2,linewidth=0,cmap=cm.rainbow)
+    surf = ax.plot_surface(X,Y,Z,rstride=1,cstride=1,linewidth=0,cmap=cm.rainbow)
     ax.set_zlim3d(-1.0,1.0)
     ax.view_init(elev=elev, azim=azim)
     fig.colorbar(surf,shrink=0.5, aspect=5)
@@ -34,3 +44,44 @@ def surf3d(x,y,Z,window_title='Figure',ax_title='',fig='None',azim=-50,elev=25):
 
     return ax
 
+
+def decimate(x,y,Z,max_polys=MAX_POLYS,smooth=True):
+    '''
+    Reduces an x,y,Z surface to at most about max_polys grid cells.
+
+    Parameters
+    ----------
+    x: row axis, X x 1 numpy array
+    y: column axis, Y x 1 numpy array
+    Z: X x Y numpy array
+    max_polys: polygon budget, None to keep the full grid
+    smooth: True to average blocks of points, False to take every n-th point
+
+    Returns
+    -------
+    X, Y, Z: grids as from np.meshgrid(y,x) and the matching surface
+
+    '''
+    step = 1
+    if max_polys:
+        step = max(int(np.ceil(np.sqrt(Z.size / float(max_polys)))), 1)
+    if step == 1:
+        X,Y = image_grid(x,y)['grids']
+        return X,Y,Z
+
+    x = np.ravel(x)
+    y = np.ravel(y)
+    if smooth:
+        rows = np.arange(0,len(x),step)
+        cols = np.arange(0,len(y),step)
+        nrows = np.diff(np.append(rows,len(x)))
+        ncols = np.diff(np.append(cols,len(y)))
+        Z = np.add.reduceat(np.add.reduceat(Z,rows,axis=0),cols,axis=1) / np.outer(nrows,ncols)
+        x = np.add.reduceat(x,rows) / nrows
+        y = np.add.reduceat(y,cols) / ncols
+    else:
+        Z = Z[::step,::step]
+        x = x[::step]
+        y = y[::step]
+    X,Y = np.meshgrid(y,x)
+    return X,Y,Z
@@ -0,0 +1,157 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+"""Opt-in timing of the load, analysis, fitting and plotting stages."""
+
+ENABLED = False  # Set with enable()/disable() or the profile() context manager
+_records = []
+_stack = []
+
+
+class _Stage(object):
+    """Context manager timing one stage; extra information is attached with add()."""
+
+    def __init__(self, name, info):
+        self.record = dict(info)
+        self.record['stage'] = name
+
+    def add(self, **info):
+        """Attach information to the record, e.g. array sizes or iteration counts."""
+        self.record.update(info)
+        return self
+
+    def __enter__(self):
+        _stack.append(self.record['stage'])
+        self.record['path'] = ';'.join(_stack)
+        self.record['start'] = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.record['duration'] = time.perf_counter() - self.record['start']
+        _stack.pop()
+        _records.append(self.record)
+        return False
+
+
+class _NullStage(object):
+    """Shared do-nothing stage returned while profiling is disabled."""
+
+    def add(self, **info):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, **info):
+    """
+    Time a stage of the pipeline:
+        with profiling.stage('fit', analysis_type='pca') as s:
+            ...
+            s.add(n_iter=fit_object.n_iter_)
+    While profiling is disabled this returns a shared no-op object, so the cost is a
+    single flag check per stage.
+    :param name: stage name, nested stages are recorded with their full path
+    :param info: extra fields stored in the record, e.g. nbytes
+    :return: context manager
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _Stage(name, info)
+
+
+def enable():
+    """Start recording stages."""
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    """Stop recording stages; the records collected so far are kept."""
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    """Discard the records collected so far."""
+    del _records[:]
+
+
+@contextmanager
+def profile():
+    """
+    Record the stages run inside a with block:
+        with profiling.profile() as records:
+            data, w1, w3, tau2 = util.loadSolvent('DMSO')
+    :return: list of records, filled in as the stages finish
+    """
+    global ENABLED
+    previous = ENABLED
+    start = len(_records)
+    out = []
+    ENABLED = True
+    try:
+        yield out
+    finally:
+        ENABLED = previous
+        out.extend(_records[start:])
+
+
+def records():
+    """
+    Return the recorded stages, in the order they finished.
+    :return: list of dicts with 'stage', 'path' (';'-joined nesting of stage names),
+             'start' and 'duration' (s), plus any information added by the stage
+    """
+    return list(_records)
+
+
+def summary(recs=None):
+    """
+    Total the recorded time per stage path.
+    :param recs: optional list of records (default: all records)
+    :return: dict of path -> (number of calls, total seconds)
+    """
+    totals = {}
+    for rec in _records if recs is None else recs:
+        calls, seconds = totals.get(rec['path'], (0, 0.0))
+        totals[rec['path']] = (calls + 1, seconds + rec['duration'])
+    return totals
+
+
+def write_json(filename, recs=None):
+    """
+    Write the records as a JSON list of structured records.
+    :param filename: output file
+    :param recs: optional list of records (default: all records)
+    """
+    with open(filename, 'w') as f:
+        json.dump(_records if recs is None else recs, f, indent=1, default=str)
+
+
+def write_collapsed(filename, recs=None):
+    """
+    Write the records in the collapsed-stack format read by flamegraph.pl and speedscope:
+    one 'outer;inner <microseconds>' line per stage path, with self time (time not spent
+    in nested stages).
+    :param filename: output file
+    :param recs: optional list of records (default: all records)
+    """
+    recs = _records if recs is None else recs
+    totals = {}
+    for path, (calls, seconds) in summary(recs).items():
+        totals[path] = totals.get(path, 0.0) + seconds
+        parent = path.rpartition(';')[0]
+        if parent:
+            totals[parent] = totals.get(parent, 0.0) - seconds
+    with open(filename, 'w') as f:
+        for path in sorted(totals):
+            f.write('%s %d\n' % (path, max(int(round(totals[path] * 1e6)), 0)))
@@ -0,0 +1,67 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.figure import Figure
+
+import plot
+
+
+"""Render report figures for batch results to files, without a display."""
+
+T_SCALE = 1000  # Plot times in ps, matching batch.T_SCALE
+
+
+def render_report(results, outdir, formats=('png',), processes=None):
+    """
+    Render components, contributions and fits of every batch result to image files.
+    Each result is rendered by a worker process on figures not attached to pyplot,
+    so no display or interactive backend is needed.
+    :param results: dict from batch.run_batch, keyed by (solvent, analysis_type, n_comp)
+    :param outdir: directory to write the files to, created if needed
+    :param formats: list of file formats understood by matplotlib, e.g. ('png', 'pdf')
+    :param processes: int, number of worker processes (default: one per CPU)
+    :return: list of the files written
+    """
+    os.makedirs(outdir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(render_result, key, result, outdir, formats)
+                   for key, result in results.items()]
+        return [filename for future in futures for filename in future.result()]
+
+
+def render_result(key, result, outdir, formats=('png',)):
+    """
+    Render one figure per component of a batch result: the component image next to its
+    contribution vs. time and exponential fit. One figure and axes set is reused for all
+    components.
+    :param key: (solvent, analysis_type, n_comp) tuple, used to name the files
+    :param result: dict with 'components', 'projections', 'popt', 'w1', 'w3', 'tau2'
+    :param outdir: directory to write the files to
+    :param formats: list of file formats understood by matplotlib
+    :return: list of the files written
+    """
+    comp = result['components']
+    proj = result['projections']
+    tau2 = result['tau2']
+    prefix = os.path.join(outdir, '_'.join(str(k) for k in key))
+
+    fig = Figure(figsize=(2 * plot.FIG_SIZE + 2, plot.FIG_SIZE))
+    ax_img, ax_fit = fig.subplots(1, 2)
+    fig.subplots_adjust(wspace=0.4, bottom=0.2)
+
+    written = []
+    for i in range(comp.shape[2]):
+        ax_img.cla()
+        ax_fit.cla()
+        plot.plot_image(ax_img, comp[:, :, i], result['w1'], result['w3'], 'bwr')
+        ax_img.set_title("Component " + str(i+1), fontsize=14)
+        plot.plot_contribution(ax_fit, tau2/T_SCALE, proj, i+1)
+        if 'popt' in result and np.all(np.isfinite(result['popt'][i])):
+            plot.plot_exp_fit(ax_fit, result['popt'][i], tau2/T_SCALE)
+        ax_fit.set_xlabel("Time (ps)")
+        for fmt in formats:
+            filename = prefix + '_c' + str(i+1) + '.' + fmt
+            fig.savefig(filename)
+            written.append(filename)
+    return written
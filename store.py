@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+"""Save fitted decompositions, projections and fit parameters on disk and find them again."""
+
+# Directory of the results store
+RESULTS_DIR = os.environ.get('SPECTRO_RESULTS_DIR', '.spectro_results')
+INDEX_FILE = 'index.json'
+META_FILE = 'meta.json'
+# Fit object attributes saved with a result, when present
+FIT_ARRAYS = ('components_', 'mean_', 'mixing_', 'whitening_', 'explained_variance_',
+              'explained_variance_ratio_', 'singular_values_', 'noise_variance_')
+# Image stacks (X, Y, N) are saved image by image, (N, X, Y), so one image is one contiguous read
+IMAGE_STACKS = ('components',)
+
+
+def save_result(result, solvent, analysis_type, n_comp, data_hash, options=None,
+                fit_object=None, store_dir=None):
+    """
+    Save a result to the store, replacing any result saved under the same index values.
+    Every array is written to its own .npy file, under a temporary name and renamed into
+    place, and the entry's metadata is written last, so readers never see a partial result.
+    :param result: dict of numpy arrays, e.g. from batch.run_job ('components',
+                   'projections', 'popt', 'pcov', 'w1', 'w3', 'tau2')
+    :param solvent: solvent name
+    :param analysis_type: 'pca', 'ica' or 'fa'
+    :param n_comp: int, number of components
+    :param data_hash: analysis.data_hash of the analyzed data
+    :param options: optional dict of the preprocessing and fit options (JSON types),
+                    e.g. {'normalize': True, 'solver': 'auto'}
+    :param fit_object: optional fit object from analysis.do_analysis, its FIT_ARRAYS are
+                       saved too under the same names
+    :param store_dir: store directory, defaults to RESULTS_DIR
+    :return: string, id of the entry
+    """
+    root = store_dir or RESULTS_DIR
+    entry = {'solvent': solvent, 'analysis_type': analysis_type, 'n_comp': int(n_comp),
+             'data_hash': data_hash, 'options': options or {}}
+    entry_id = _entry_id(entry)
+    path = os.path.join(root, entry_id)
+
+    arrays = dict(result)
+    for name in FIT_ARRAYS:
+        if fit_object is not None and np.ndim(getattr(fit_object, name, None)):
+            arrays[name] = getattr(fit_object, name)
+
+    os.makedirs(path, exist_ok=True)
+    meta_file = os.path.join(path, META_FILE)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    tmp = '.' + str(os.getpid()) + '.tmp'
+    for name, arr in arrays.items():
+        arr = np.asarray(arr)
+        if name in IMAGE_STACKS:
+            arr = np.moveaxis(arr, 2, 0)
+        filename = os.path.join(path, name + '.npy')
+        with open(filename + tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(arr))
+        os.replace(filename + tmp, filename)
+
+    entry.update(id=entry_id, arrays=sorted(arrays), created=time.time())
+    with open(meta_file + tmp, 'w') as f:
+        json.dump(entry, f, indent=1)
+    os.replace(meta_file + tmp, meta_file)
+    _update_index(root, {entry_id: entry})
+    return entry_id
+
+
+def find_results(store_dir=None, exact=False, **criteria):
+    """
+    Return the index entries of the saved results matching all the given values, e.g.
+        find_results(solvent='DMSO', analysis_type='pca', n_comp=10,
+                     options={'normalize': True})
+    Options match when every given option has the saved value, or with exact=True when the
+    saved options are exactly the given ones, as needed to reuse a result in place of a fit.
+    :param store_dir: store directory, defaults to RESULTS_DIR
+    :param exact: boolean, True to match only entries saved with no other options
+    :param criteria: values of 'solvent', 'analysis_type', 'n_comp', 'data_hash', 'options'
+    :return: list of dicts, newest first, each with the index values, 'id', 'arrays'
+             (names of the saved arrays) and 'created' (time.time() of the save)
+    """
+    options = criteria.pop('options', {})
+    found = []
+    for entry in _read_index(store_dir or RESULTS_DIR).values():
+        if any(entry.get(k) != v for k, v in criteria.items()):
+            continue
+        if exact and entry['options'] != options:
+            continue
+        if any(entry['options'].get(k) != v for k, v in options.items()):
+            continue
+        found.append(entry)
+    return sorted(found, key=lambda entry: -entry['created'])
+
+
+def load_result(entry, store_dir=None, mmap_mode='r'):
+    """
+    Load a saved result. Arrays are memory-mapped, so only the parts used are read from disk,
+    and the dict can be passed straight to the plot functions, e.g.
+        plot.show_component(r['components'], r['w1'], r['w3'], 1)
+    :param entry: index entry from find_results, or its id
+    :param store_dir: store directory, defaults to RESULTS_DIR
+    :param mmap_mode: numpy.memmap mode ('r' or 'c'), or None to read the arrays into memory
+    :return: dict of numpy arrays (or numpy.memmap), as saved by save_result
+    """
+    entry_id = entry if isinstance(entry, str) else entry['id']
+    path = os.path.join(store_dir or RESULTS_DIR, entry_id)
+    with open(os.path.join(path, META_FILE)) as f:
+        names = json.load(f)['arrays']
+    out = {}
+    for name in names:
+        arr = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+        out[name] = np.moveaxis(arr, 0, 2) if name in IMAGE_STACKS else arr
+    return out
+
+
+def remove_result(entry, store_dir=None):
+    """
+    Delete a saved result and its index entry.
+    :param entry: index entry from find_results, or its id
+    :param store_dir: store directory, defaults to RESULTS_DIR
+    """
+    root = store_dir or RESULTS_DIR
+    entry_id = entry if isinstance(entry, str) else entry['id']
+    shutil.rmtree(os.path.join(root, entry_id), ignore_errors=True)
+    _update_index(root, {entry_id: None})
+
+
+def _entry_id(entry):
+    """Return the id of an entry, a hash of its index values."""
+    key = json.dumps(entry, sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _read_index(root):
+    """
+    Return the index of a store, a dict of id -> entry.
+    Entries whose metadata exists but that are missing from the index (e.g. saved by
+    concurrent writers) are added, and entries whose directory was removed are dropped.
+    """
+    try:
+        with open(os.path.join(root, INDEX_FILE)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    try:
+        names = set(n for n in os.listdir(root) if os.path.isdir(os.path.join(root, n)))
+    except OSError:
+        return {}
+    changed = {}
+    for entry_id in names.difference(index):
+        try:
+            with open(os.path.join(root, entry_id, META_FILE)) as f:
+                changed[entry_id] = json.load(f)
+        except (OSError, ValueError):
+            pass
+    for entry_id in set(index).difference(names):
+        changed[entry_id] = None
+    if changed:
+        index = _update_index(root, changed, index)
+    return index
+
+
+def _update_index(root, changes, index=None):
+    """
+    Apply changes (id -> entry, or None to remove) to the index file and return the index.
+    The file is replaced atomically; entries lost to a concurrent update are recovered by
+    _read_index from their metadata.
+    """
+    if index is None:
+        try:
+            with open(os.path.join(root, INDEX_FILE)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+    for entry_id, entry in changes.items():
+        if entry is None:
+            index.pop(entry_id, None)
+        else:
+            index[entry_id] = entry
+    filename = os.path.join(root, INDEX_FILE)
+    tmp = filename + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, filename)
+    except OSError:
+        pass
+    return index
@@ -0,0 +1,174 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.stats import norm
+
+import analysis
+import batch
+import fits
+import profiling
+
+
+"""Bootstrap and jackknife confidence bands for components and decay lifetimes."""
+
+METHODS = ('bootstrap', 'jackknife')
+CHUNK_SIZE = 8  # Replicates refitted per worker task
+_worker = {}  # Data and full fit shared by the replicates refitted in a worker process
+
+
+def estimate_uncertainty(data, tau2, normalize=True, n_comp=10, analysis_type='pca',
+                         method='bootstrap', n_resamples=200, level=0.95, seed=None,
+                         solver='auto', processes=None, blas_threads=1):
+    """
+    Estimate confidence bands of the component images and of the lifetime of each component
+    by resampling the tau2 images and repeating the decomposition and exponential fits.
+    Every replicate is described by a weight per image: the number of times a bootstrap
+    replicate draws it, or 0 for the image a jackknife replicate leaves out. The projections
+    of a replicate cover all Z images, so the weighted exponential fits of every replicate
+    and component run as one fits.batch_fit call.
+    PCA replicates are exact updates of a single SVD: every image lies in the span of the Z
+    right singular vectors of the data, so a replicate only needs the SVD of a Z x Z matrix,
+    and all replicates are done at once. ICA and FA replicates are refitted with
+    analysis.do_analysis, warm-started from the fit of all images, on a process pool.
+    :param data: numpy array, set of Z images, each X x Y
+    :param tau2: list of times, Z x 1 numpy array (fs)
+    :param normalize: boolean, True to normalize data before doing analysis
+    :param n_comp: int, number of components to generate
+    :param analysis_type: 'pca' (default), 'ica' or 'fa'
+    :param method: 'bootstrap' (default) to draw Z images with replacement,
+                   'jackknife' to leave out one tau2 image at a time (Z replicates)
+    :param n_resamples: int, number of bootstrap replicates
+    :param level: float, confidence level of the bands
+    :param seed: int, random seed for the bootstrap draws and the refits
+    :param solver: string for the SVD solver, see analysis.SOLVERS
+    :param processes: int, number of worker processes for ICA and FA (default: one per CPU)
+    :param blas_threads: int, BLAS/OpenMP threads allowed in each worker
+    :return: dict of numpy arrays
+             'components': (X, Y, n_comp) components of all images
+             'components_std': (X, Y, n_comp) standard error of every pixel
+             'components_low', 'components_high': (X, Y, n_comp) confidence band
+                                                  (normal approximation)
+             'lifetimes': (n_comp,) lifetime in ps (1/rate of fits.my_exponential)
+             'lifetimes_low', 'lifetimes_high': (n_comp,) confidence interval, bootstrap
+                                                percentiles or jackknife normal approximation
+             'lifetime_samples': (n_replicates, n_comp) lifetime of every replicate
+             'weights': (n_replicates, Z) weight of every image in every replicate
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown resampling method: ' + str(method))
+    n_images = data.shape[2]
+    t = np.ravel(tau2) / batch.T_SCALE
+    z = norm.ppf(0.5 + level / 2)
+
+    base = analysis.do_analysis(data, normalize, n_comp, analysis_type, solver=solver,
+                                random_state=seed)
+    base_proj = analysis.get_projections(data, normalize, n_comp, analysis_type,
+                                         solver=solver, random_state=seed)
+    base_popt = fits.batch_fit(fits.my_exponential, t, base_proj)[0]
+
+    if method == 'bootstrap':
+        rng = np.random.RandomState(seed)
+        weights = rng.multinomial(n_images, np.full(n_images, 1.0 / n_images), n_resamples)
+    else:
+        weights = 1 - np.eye(n_images, dtype=int)
+    n_rep = weights.shape[0]
+    # Spread of the replicates to variance of the estimate
+    scale = n_rep / (n_rep - 1.0) if method == 'bootstrap' else n_rep - 1.0
+
+    with profiling.stage('replicates', method=method, n_replicates=n_rep,
+                         analysis_type=analysis_type):
+        if analysis_type == 'pca':
+            proj, var = _pca_replicates(data, normalize, n_comp, base, weights)
+        else:
+            proj, var = _refit_replicates(data, normalize, n_comp, analysis_type, solver, seed,
+                                          base, weights, processes, blas_threads)
+    std = np.sqrt(var * scale)
+
+    # Columns ordered replicate by replicate, component by component
+    Y = proj.transpose(1, 0, 2).reshape(n_images, -1)
+    popt = fits.batch_fit(fits.my_exponential, t, Y, weights=np.repeat(weights.T, n_comp, 1))[0]
+    samples = 1 / popt[:, 1].reshape(n_rep, n_comp)
+    lifetimes = 1 / base_popt[:, 1]
+    if method == 'bootstrap':
+        low, high = np.nanpercentile(samples, [50 - 50 * level, 50 + 50 * level], axis=0)
+    else:
+        spread = np.sqrt(np.nanvar(samples, axis=0) * scale)
+        low, high = lifetimes - z * spread, lifetimes + z * spread
+
+    shape = data.shape[:2]
+    comp = np.array(analysis.unreshape_image(base.components_, *shape))
+    std = np.array(analysis.unreshape_image(std, *shape))
+    return {'components': comp, 'components_std': std,
+            'components_low': comp - z * std, 'components_high': comp + z * std,
+            'lifetimes': lifetimes, 'lifetimes_low': low, 'lifetimes_high': high,
+            'lifetime_samples': samples, 'weights': weights}
+
+
+def _pca_replicates(data, normalize, n_comp, base, weights):
+    """
+    Weighted PCA of every replicate from one SVD of the data, all replicates at once.
+    :return: projections of all images for every replicate, (n_rep, Z, n_comp) numpy array
+             mean squared deviation of every component pixel, (n_comp, X*Y) numpy array
+    """
+    raw = analysis.preprocess(data)
+    _, _, basis = np.linalg.svd(raw, full_matrices=False)
+    # Coordinates in the basis of the raw and the fitted (normalized) images, Z x Z
+    raw_c = np.dot(raw, basis.T)
+    fit_c = np.dot(analysis.preprocess(data, normalize), basis.T) if normalize else raw_c
+    base_c = np.dot(base.components_, basis.T)
+
+    w = weights.astype(float)
+    mean = np.dot(w, fit_c) / w.sum(axis=1)[:, None]
+    centered = np.sqrt(w)[:, :, None] * (fit_c[None] - mean[:, None])
+    comp = np.linalg.svd(centered, full_matrices=False)[2][:, :n_comp]
+    # Same signs as the components of all images, PCA keeps the variance order
+    comp *= np.where(np.einsum('bkr,kr->bk', comp, base_c) < 0, -1, 1)[:, :, None]
+    proj = np.matmul(raw_c[None] - mean[:, None], comp.transpose(0, 2, 1))
+
+    dev = comp - comp.mean(axis=0)
+    cov = np.einsum('bki,bkj->kij', dev, dev) / len(w)
+    var = np.einsum('kip,ip->kp', np.einsum('kij,jp->kip', cov, basis), basis)
+    return proj, np.maximum(var, 0)
+
+
+def _refit_replicates(data, normalize, n_comp, analysis_type, solver, seed, base, weights,
+                      processes, blas_threads):
+    """
+    Refit every replicate with do_analysis on a process pool.
+    :return: projections of all images for every replicate, (n_rep, Z, n_comp) numpy array
+             mean squared deviation of every component pixel, (n_comp, X*Y) numpy array
+    """
+    options = (normalize, n_comp, analysis_type, solver, seed)
+    chunks = [weights[i:i + CHUNK_SIZE] for i in range(0, len(weights), CHUNK_SIZE)]
+    proj = []
+    total = total_sq = 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(blas_threads, np.asarray(data), base, options)) as pool:
+        for comp, chunk_proj in pool.map(_refit_chunk, chunks):
+            total = total + comp.sum(axis=0)
+            total_sq = total_sq + (comp**2).sum(axis=0)
+            proj.append(chunk_proj)
+    mean = total / len(weights)
+    return np.concatenate(proj), np.maximum(total_sq / len(weights) - mean**2, 0)
+
+
+def _init_worker(blas_threads, data, base, options):
+    """Keep the data and full fit in a worker process, and cap its BLAS threads."""
+    batch._limit_threads(blas_threads)
+    _worker.update(data=data, base=base, options=options)
+
+
+def _refit_chunk(weights):
+    """Refit the replicates given by rows of image weights, in a worker process."""
+    data, base = _worker['data'], _worker['base']
+    normalize, n_comp, analysis_type, solver, seed = _worker['options']
+    raw = analysis.preprocess(data)
+    comps = []
+    projs = []
+    for w in weights:
+        images = data[:, :, np.repeat(np.arange(len(w)), w)]
+        fit_object = analysis.do_analysis(images, normalize, n_comp, analysis_type,
+                                          solver=solver, random_state=seed, init=base)
+        comps.append(fit_object.components_)
+        projs.append(fit_object.transform(raw))
+    return np.array(comps), np.array(projs)
@@ -1,19 +1,90 @@
+import hashlib
+import json
+import os
+import warnings
+
 import numpy as np
-from scipy.io import loadmat
 
+import profiling
+
+# Solvents with data in the 2D-IR-Data_SNP_NO_Brookes_JPCB_2013 set
+SOLVENTS = ['D2O', 'DMSO', 'EG', 'EtOH', 'FA', 'H2O', 'MeOH']
+
+# Directory for the .npy cache written by loadSolvent
+CACHE_DIR = os.environ.get('SPECTRO_CACHE_DIR', '.spectro_cache')
+CACHE_KEYS = ('data', 'w1', 'w3', 'tau2')
+CACHE_MANIFEST = 'sources.json'
+
+# MAT-file v5 element types and the array classes whose payload
+# can be memory-mapped directly (stored type == class type)
+_MI_MATRIX = 14
+_MI_DTYPES = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4',
+              7: 'f4', 9: 'f8', 12: 'i8', 13: 'u8'}
+_MX_CLASS_TYPES = {6: 9, 7: 7, 8: 1, 9: 2, 10: 3, 11: 4, 12: 5, 13: 6,
+                   14: 12, 15: 13}
 
-def loadSolvent(name):
+
+def loadSolvent(name, cache=True, cache_dir=None):
     '''
     Loads all the necessary data arrays for a given solvent.
+
+    The matched arrays are cached on disk as .npy files, so later
+    calls memory-map them instead of re-parsing the MATLAB files.
+    The cache is rebuilt whenever a source file changes.
     
     Parameters
     ----------
     name : string of the solvent name
+    cache : boolean, False to bypass the on-disk cache
+    cache_dir : cache directory, defaults to CACHE_DIR
 
     Returns
     -------
     out : list containing the data arrays
 
+    '''
+    with profiling.stage('loadSolvent', solvent=name) as s:
+        sources = solventFiles(name)
+        if cache:
+            path = os.path.join(cache_dir or CACHE_DIR, name)
+            with profiling.stage('readCache'):
+                out = _readCache(path, sources)
+            if out is not None:
+                s.add(cached=True, nbytes=out[0].nbytes)
+                return out
+
+        W1_NAME, W3_NAME, TAU2_NAME, DATA_ARRAY_NAME = sources
+        xw1 = loadData(W1_NAME)
+        xw3 = loadData(W3_NAME)
+        xt2 = loadData(TAU2_NAME)
+        xdata = loadData(DATA_ARRAY_NAME)
+
+        with profiling.stage('matchDims'):
+            data, vec_list = matchDims(xdata,[xw1,xw3,xt2])
+        w1 = vec_list[0]
+        w3 = vec_list[1]
+        tau2 = vec_list[2]
+
+        if cache:
+            with profiling.stage('writeCache'):
+                _writeCache(path, sources, (data,w1,w3,tau2))
+        s.add(cached=False, nbytes=data.nbytes, shape=data.shape)
+
+    return data,w1,w3,tau2
+
+
+def solventFiles(name):
+    '''
+    Returns the MATLAB files holding the data for a given solvent.
+
+    Parameters
+    ----------
+    name : string of the solvent name
+
+    Returns
+    -------
+    out : list of the w1, w3, tau2 and data file paths
+
     '''
     PREFIX = '2D-IR-Data_SNP_NO_Brookes_JPCB_2013/'
 
@@ -55,43 +126,210 @@ def loadSolvent(name):
     else:
        raise ValueError('Solvent name not found')
 
-    xw1 = loadData(W1_NAME)
-    xw3 = loadData(W3_NAME)
-    xt2 = loadData(TAU2_NAME)
-    xdata = loadData(DATA_ARRAY_NAME)
 
-    data, vec_list = matchDims(xdata,[xw1,xw3,xt2])
-    w1 = vec_list[0]
-    w3 = vec_list[1]
-    tau2 = vec_list[2]
+    return [W1_NAME, W3_NAME, TAU2_NAME, DATA_ARRAY_NAME]
+
+
+def _fileHash(filename):
+    '''
+    Returns the SHA-1 hex digest of a file's contents.
+    '''
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
 
-    return data,w1,w3,tau2
+
+def _readCache(path, sources):
+    '''
+    Returns the memory-mapped (data, w1, w3, tau2) arrays cached in
+    directory `path`, or None if the cache is missing or stale.
+
+    A source whose mtime or size changed is only considered stale if
+    its content hash changed too, so touching or copying the raw data
+    does not force a rebuild.
+    '''
+    try:
+        with open(os.path.join(path, CACHE_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if [m['path'] for m in manifest] != list(sources):
+        return None
+    touched = False
+    for m in manifest:
+        try:
+            st = os.stat(m['path'])
+        except OSError:
+            return None
+        if (st.st_mtime_ns, st.st_size) != (m['mtime_ns'], m['size']):
+            if st.st_size != m['size'] or _fileHash(m['path']) != m['sha1']:
+                return None
+            m['mtime_ns'] = st.st_mtime_ns
+            touched = True
+    if touched:
+        try:
+            with open(os.path.join(path, CACHE_MANIFEST), 'w') as f:
+                json.dump(manifest, f, indent=1)
+        except OSError:
+            pass
+
+    try:
+        return tuple(np.load(os.path.join(path, key + '.npy'), mmap_mode='c')
+                     for key in CACHE_KEYS)
+    except (OSError, ValueError):
+        return None
 
 
-def loadData(filename):
+def _writeCache(path, sources, arrays):
+    '''
+    Saves the (data, w1, w3, tau2) arrays to directory `path` as .npy
+    files. The manifest describing the sources is written last, so an
+    interrupted write never leaves a cache that looks valid. Each file
+    is written under a temporary name and renamed into place, so
+    concurrent writers (e.g. batch workers) never see partial files.
+    '''
+    try:
+        os.makedirs(path, exist_ok=True)
+        manifest_file = os.path.join(path, CACHE_MANIFEST)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        tmp = '.' + str(os.getpid()) + '.tmp'
+        for key, arr in zip(CACHE_KEYS, arrays):
+            filename = os.path.join(path, key + '.npy')
+            with open(filename + tmp, 'wb') as f:
+                np.save(f, np.asanyarray(arr))
+            os.replace(filename + tmp, filename)
+        manifest = []
+        for src in sources:
+            st = os.stat(src)
+            manifest.append({'path': src, 'mtime_ns': st.st_mtime_ns,
+                             'size': st.st_size, 'sha1': _fileHash(src)})
+        with open(manifest_file + tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_file + tmp, manifest_file)
+    except OSError as err:
+        warnings.warn('Could not write solvent cache to ' + path + ': ' + str(err))
+
+
+def loadData(filename, mmap_mode='c'):
     '''
     Loads a .mat (MATLAB) file and returns
     the vector/matrix as a numpy array.
 
+    Only the last variable stored in the file is read. Uncompressed
+    v5 files and contiguous v7.3 (HDF5) datasets are memory-mapped
+    instead of being read into memory.
+
     Parameters
     ----------
     filename: string containing path of file
+    mmap_mode: numpy.memmap mode used when the variable can be
+        memory-mapped ('r', 'c' or 'r+'), or None to always read
+        the data into memory. The default 'c' (copy-on-write) never
+        modifies the file.
 
     Returns
     -------
-    out: a numpy array
+    out: a numpy array (or numpy.memmap)
 
     '''
-    raw = loadmat(filename)
-    for key in raw.keys():
-        if (key[:2]=='__'):
-            pass
+    with profiling.stage('loadData', filename=filename) as s:
+        with open(filename, 'rb') as f:
+            header = f.read(128)
+        if header.startswith(b'MATLAB 7.3'):
+            out = _loadHDF5(filename, mmap_mode)
         else:
-            out = raw[key]
+            from scipy.io import loadmat, whosmat
+            name = [v[0] for v in whosmat(filename) if v[0][:2] != '__'][-1]
+            out = None
+            if mmap_mode is not None:
+                out = _mmapV5(filename, name, header, mmap_mode)
+            if out is None:
+                out = loadmat(filename, variable_names=[name])[name]
+        s.add(nbytes=out.nbytes, mmap=isinstance(out, np.memmap))
+    return out
 
+
+def _mmapV5(filename, name, header, mmap_mode):
+    '''
+    Memory-maps variable `name` of an uncompressed v5 MAT-file.
+    Returns None if the variable is compressed, complex, logical,
+    sparse or stored with a narrower type than its class.
+    '''
+    endian = '<' if header[126:128] == b'IM' else '>'
+    u4 = np.dtype(endian + 'u4')
+    with open(filename, 'rb') as f:
+        f.seek(128)
+        while True:
+            tag = f.read(8)
+            if len(tag) < 8:
+                return None
+            mtype, nbytes = map(int, np.frombuffer(tag, u4))
+            start = f.tell()
+            if mtype == _MI_MATRIX:
+                elems = _readV5Elements(f, u4, 3)
+                flags, dims, vname = elems
+                mflags = int(np.frombuffer(flags[1][:4], u4)[0])
+                mclass = mflags & 0xFF
+                is_special = mflags & 0x0A00  # complex or logical
+                if vname[1].rstrip(b'\0').decode() == name:
+                    tag = f.read(8)
+                    dtype, nbytes = map(int, np.frombuffer(tag, u4))
+                    if (is_special or dtype & 0xFFFF0000
+                            or _MX_CLASS_TYPES.get(mclass) != dtype):
+                        return None
+                    shape = tuple(int(n) for n in np.frombuffer(dims[1], endian + 'i4'))
+                    return np.memmap(filename, dtype=endian + _MI_DTYPES[dtype],
+                                     mode=mmap_mode, offset=f.tell(),
+                                     shape=shape, order='F')
+            f.seek(start + nbytes + (-nbytes % 8))
+
+
+def _readV5Elements(f, u4, count):
+    '''
+    Reads `count` consecutive v5 data elements from an open file,
+    returning (type, payload) pairs. Handles small-element packing.
+    '''
+    out = []
+    for i in range(count):
+        tag = f.read(8)
+        mtype, nbytes = map(int, np.frombuffer(tag, u4))
+        if mtype >> 16:  # small data element: payload packed into the tag
+            out.append((mtype & 0xFFFF, tag[4:4 + (mtype >> 16)]))
+        else:
+            out.append((mtype, f.read(nbytes)))
+            f.read(-nbytes % 8)
     return out
 
 
+def _loadHDF5(filename, mmap_mode):
+    '''
+    Loads the last variable of a v7.3 (HDF5) MAT-file, memory-mapping
+    it when the dataset is stored contiguously without compression.
+    Requires h5py.
+    '''
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('h5py is required to load v7.3 MAT-files')
+
+    with h5py.File(filename, 'r') as h5:
+        name = [k for k in h5.keys() if k[0] != '#'][-1]
+        dset = h5[name]
+        offset = dset.id.get_offset()
+        if (mmap_mode is not None and offset is not None
+                and dset.chunks is None and dset.compression is None):
+            out = np.memmap(filename, dtype=dset.dtype, mode=mmap_mode,
+                            offset=offset, shape=dset.shape)
+        else:
+            out = dset[()]
+    # MATLAB is column-major, so HDF5 stores the transposed array
+    return out.T
+
+
 def matchDims(main,obj_list):
     '''
     Truncates and matches dimensions of multidimensional arrays.
@@ -114,7 +352,8 @@ def matchDims(main,obj_list):
     for i in range(len(dims)):
         idim = len(obj_list[i])
         if(idim < dims[i]):
-            t_main = np.delete(t_main,np.s_[idim:],i)
+            # slicing keeps a view (of a memmap, if loaded lazily)
+            t_main = t_main[(slice(None),)*i + (slice(0,idim),)]
             t_obj_list.append(obj_list[i])
         else:
             t_obj_list.append(obj_list[i][:dims[i]])